@@ -0,0 +1,124 @@
+import time
+import numpy as np
+from typing import List, Tuple, Union
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from feature_extraction import PatternTracker
+from distances import distance_block
+
+
+class CentroidIndex:
+    """
+    Centroids of the relation clusters, to place new entity pairs without clustering everything again
+    For cosine, rows and centroids are L2-normalised, so the nearest centroid is the one with the highest dot product
+    """
+
+    def __init__(self, pp_matrix: Union[np.ndarray, sparse.spmatrix], labels: np.ndarray, n_clusters: int,
+                 metric: str = 'cosine'):
+
+        self.metric = metric
+        self.n_clusters = n_clusters
+
+        rows = sparse.csr_matrix(pp_matrix, dtype=np.float64)
+        if metric == 'cosine':
+            rows = normalize(rows, norm='l2', axis=1)
+
+        # cluster-indicator matrix weighted by 1 / cluster size, so the product gives the mean of each cluster
+        labels = np.asarray(labels)
+        sizes = np.bincount(labels, minlength=n_clusters)
+        weights = 1.0 / sizes[labels]
+        indicator = sparse.csr_matrix((weights, (labels, np.arange(len(labels)))), shape=(n_clusters, len(labels)))
+
+        self.centroids = sparse.csr_matrix(indicator @ rows)
+        if metric == 'cosine':
+            self.centroids = normalize(self.centroids, norm='l2', axis=1)
+        self.centroid_sq = np.asarray(self.centroids.multiply(self.centroids).sum(axis=1)).ravel()
+
+    def assign(self, vectors: Union[np.ndarray, sparse.spmatrix], distance_threshold: float,
+               batch_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest cluster of each vector, batch by batch
+
+        :param vectors: pattern vectors of new pairs, with the same columns as the pair-pattern matrix
+        :param distance_threshold: above this distance to the nearest centroid, the pair is a new cluster
+        :param batch_size: number of vectors compared with all centroids at once
+        :return: cluster id of each vector, -1 for new cluster, and the distance to the nearest centroid
+        """
+
+        vectors = sparse.csr_matrix(vectors, dtype=np.float64)
+        if self.metric == 'cosine':
+            vectors = normalize(vectors, norm='l2', axis=1)
+        vector_sq = np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel()
+
+        labels = np.full(vectors.shape[0], -1, dtype=np.int64)
+        distances = np.full(vectors.shape[0], np.inf)
+
+        for start in range(0, vectors.shape[0], batch_size):
+            end = min(start + batch_size, vectors.shape[0])
+
+            block = distance_block(vectors[start:end], self.centroids, self.metric,
+                                   vector_sq[start:end], self.centroid_sq)
+            nearest = block.argmin(axis=1)
+
+            labels[start:end] = nearest
+            distances[start:end] = block[np.arange(end - start), nearest]
+
+        labels[distances > distance_threshold] = -1
+
+        return labels, distances
+
+
+def pattern_vectors(new_tracker: PatternTracker,
+                    pattern_tracker: PatternTracker) -> Tuple[List[Tuple[str, str]], sparse.csr_matrix]:
+    """
+    Build pattern vectors of newly extracted pairs with the columns of the existing pair-pattern matrix
+    Patterns never seen in the existing data have no column and are left out
+
+    :param new_tracker: pattern tracker of the new extraction
+    :param pattern_tracker: pattern tracker the clusters were built from
+    :return: list of pairs, and their vectors as rows of a sparse matrix
+    """
+
+    pattern2idx = {frozenset(pattern): idx for idx, pattern in enumerate(pattern_tracker.patterns)}
+
+    pairs = list()
+    rows = list()
+    cols = list()
+    for pair, patterns in new_tracker.pairs2patterns.items():
+        if patterns:
+            pairs.append(pair)
+            for pattern in patterns:
+                idx = pattern2idx.get(frozenset(pattern))
+                if idx is not None:
+                    rows.append(len(pairs) - 1)
+                    cols.append(idx)
+
+    # duplicate (row, col) entries are summed, giving co-occurrence counts as in the pair-pattern matrix
+    matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(pairs), len(pattern_tracker.patterns)))
+
+    return pairs, matrix
+
+
+def assign_pairs(new_tracker: PatternTracker, pattern_tracker: PatternTracker, pp_matrix: sparse.spmatrix,
+                 clusters: dict, args) -> dict:
+
+    start = time.perf_counter()
+    index = CentroidIndex(pp_matrix, clusters['labels'], clusters['n_clusters'], args.distance_metric)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pairs, vectors = pattern_vectors(new_tracker, pattern_tracker)
+    labels, distances = index.assign(vectors, args.distance_threshold)
+    assign_time = time.perf_counter() - start
+
+    print('=' * 50)
+    print('Centroids of {} clusters built in {:.3f}s'.format(clusters['n_clusters'], build_time))
+    print('Assigned {} new pairs in {:.3f}s'.format(len(pairs), assign_time))
+    print('Pairs in existing clusters:', int((labels >= 0).sum()))
+    print('Pairs in new clusters:', int((labels < 0).sum()))
+    print('Ten assigned pairs:', [(pair, int(label)) for pair, label in zip(pairs[:10], labels[:10])])
+    print('=' * 50)
+
+    # { pair : (cluster id or -1 for new cluster, distance to nearest centroid) }
+    return {pair: (int(label), float(distance)) for pair, label, distance in zip(pairs, labels, distances)}
@@ -0,0 +1,367 @@
+import io
+import os
+import copy
+import json
+import time
+import shutil
+import random
+import tempfile
+import tracemalloc
+from typing import List, Tuple, Callable
+from contextlib import redirect_stdout
+
+# modules the stages import on first use, imported here so that their import time is not counted in a stage
+import rdflib
+import networkx
+from scipy.cluster import hierarchy
+from sklearn.feature_extraction.text import TfidfTransformer
+
+from read_datasets import read_data, load_compressed_data
+from entity_extraction import EntityTracker
+from feature_extraction import PatternTracker
+from extraction import extraction
+from clustering import pair_pattern_matrix, clustering, cluster_pattern_matrix, get_ranked_patterns
+from evaluation import get_cido_triples
+import distances
+
+
+# vocabulary of the synthetic sentences: (word, upos), the lemma is the word itself
+WORDS = [('inhibit', 'VERB'), ('bind', 'VERB'), ('increase', 'VERB'), ('express', 'VERB'), ('reduce', 'VERB'),
+         ('activate', 'VERB'), ('replication', 'NOUN'), ('receptor', 'NOUN'), ('cell', 'NOUN'), ('patient', 'NOUN'),
+         ('infection', 'NOUN'), ('protein', 'NOUN'), ('level', 'NOUN'), ('response', 'NOUN'), ('severe', 'ADJ'),
+         ('viral', 'ADJ'), ('human', 'ADJ'), ('the', 'DET'), ('a', 'DET'), ('in', 'ADP'), ('of', 'ADP'),
+         ('with', 'ADP'), ('by', 'ADP'), ('and', 'CCONJ')]
+DEPRELS = ['nsubj', 'obj', 'nmod', 'case', 'compound', 'acl', 'amod', 'det', 'conj', 'obl']
+NE_TYPES = ['Gene', 'Chemical', 'Disease', 'Species', 'CellLine']
+CIDO_PREDICATES = ['has role', 'treats', 'interacts with', 'part of', 'causes']
+
+STAGES = ['read_data', 'extract_features', 'pair_pattern_matrix', 'clustering', 'cluster_pattern_matrix',
+          'get_ranked_patterns', 'get_cido_triples']
+
+
+class StubWord:
+    """ Shaped like a stanza Word, with what feature extraction reads """
+
+    def __init__(self, idx: int, text: str, upos: str, head: int, deprel: str):
+
+        self.id = idx
+        self.text = text
+        self.lemma = text
+        self.upos = upos
+        self.head = head
+        self.deprel = deprel
+
+
+class StubToken:
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubSentence:
+    """ Shaped like a stanza Sentence: words with their dependency heads, and tokens """
+
+    def __init__(self, words: List[StubWord]):
+
+        self.words = words
+        self.tokens = [StubToken(word.text) for word in words]
+
+    def print_dependencies(self) -> None:
+        for word in self.words:
+            print((word.text, str(word.head), word.deprel))
+
+
+class StubDocument:
+
+    def __init__(self, sentences: List[StubSentence]):
+        self.sentences = sentences
+
+
+class StubAnalyzer:
+    """ Called on a line like a stanza Pipeline, gives back the prepared parse of the line """
+
+    def __init__(self, parses: dict):
+        self.parses = parses
+
+    def __call__(self, line: str) -> StubDocument:
+        return StubDocument([self.parses[line]])
+
+
+class StubFlairToken:
+
+    def __init__(self, idx: int):
+        self.idx = idx
+
+
+class StubSpan:
+    """ Shaped like a flair Span: its tokens, numbered from 1, and its tag """
+
+    def __init__(self, start: int, end: int, tag: str):
+
+        self.tokens = [StubFlairToken(idx) for idx in range(start, end + 1)]
+        self.tag = tag
+
+
+class StubFlairSentence:
+
+    def __init__(self, text: str):
+
+        self.text = text
+        self.spans = list()
+
+    def get_spans(self) -> List[StubSpan]:
+        return self.spans
+
+    def to_original_text(self) -> str:
+        return self.text
+
+
+class StubTagger:
+    """ Predicts like a flair tagger, gives the prepared entity spans of the sentence """
+
+    def __init__(self, spans: dict):
+        self.spans = spans
+
+    def predict(self, sentence: StubFlairSentence) -> None:
+        sentence.spans = [StubSpan(start, end, tag) for start, end, tag in self.spans[sentence.text]]
+
+
+def synthetic_sentence(rng: random.Random, num_entities: int) -> Tuple[StubSentence, List[tuple]]:
+
+    # between 6 and 39 tokens, as kept by read_data, the last one ends the sentence
+    num_tokens = rng.randint(8, 30)
+    tokens = [rng.choice(WORDS) for _ in range(num_tokens - 1)]
+
+    # two to four single-token entities, and sometimes a covid term which the tagger does not tag
+    positions = rng.sample(range(num_tokens - 1), rng.randint(2, 4))
+    spans = list()
+    for position in sorted(positions):
+        ne_type = rng.choice(NE_TYPES)
+        tokens[position] = ('{}{}'.format(ne_type.lower(), rng.randrange(num_entities)), 'PROPN')
+        spans.append((position + 1, position + 1, ne_type))
+
+    free = [idx for idx in range(num_tokens - 1) if idx not in positions]
+    if free and rng.random() < 0.3:
+        tokens[rng.choice(free)] = ('sars-cov-2', 'PROPN')
+
+    tokens.append(('.', 'PUNCT'))
+
+    # a random tree: the first word is the root, every other word hangs on one before it
+    words = [StubWord(1, tokens[0][0], tokens[0][1], 0, 'root')]
+    for idx in range(2, num_tokens + 1):
+        words.append(StubWord(idx, tokens[idx - 1][0], tokens[idx - 1][1], rng.randint(1, idx - 1),
+                              rng.choice(DEPRELS)))
+
+    return StubSentence(words), spans
+
+
+def write_vert(sentences: List[StubSentence], path_to_file: str, rng: random.Random) -> None:
+
+    # one token per line with word, tag and lemma, the last token of a sentence tagged SENT
+    # citations in between are skipped by read_data
+    with open(path_to_file, 'w', encoding='utf-8') as file:
+        for idx, sentence in enumerate(sentences):
+            if idx % 20 == 0:
+                file.write('<doc id="{}">\n'.format(idx // 20))
+
+            for word in sentence.words[:-1]:
+                file.write('{}\t{}\t{}\n'.format(word.text, word.upos, word.lemma))
+            file.write('.\tSENT\t.\n')
+
+            if rng.random() < 0.1:
+                file.write('<citation>\n')
+                for word, upos in rng.sample(WORDS, 8):
+                    file.write('{}\t{}\t{}\n'.format(word, upos, word))
+                file.write('.\tSENT\t.\n</citation>\n')
+
+            if idx % 20 == 19 or idx == len(sentences) - 1:
+                file.write('</doc>\n')
+
+
+def write_cido(num_entities: int, num_triples: int, path_to_file: str, rng: random.Random) -> None:
+
+    # CIDO-like ontology in Turtle: labelled nodes, half of them with the text of our synthetic entities
+    obo = 'http://purl.obolibrary.org/obo/'
+    labels = ['{}{}'.format(ne_type, idx) for ne_type in NE_TYPES for idx in range(0, num_entities, 2)]
+    labels.extend('Unrelated term {}'.format(idx) for idx in range(len(labels)))
+    labels.append('SARS-CoV-2')
+
+    with open(path_to_file, 'w', encoding='utf-8') as file:
+        file.write('@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .\n\n')
+
+        for idx, label in enumerate(labels):
+            file.write('<{}CIDO_{:07d}> rdfs:label "{}" .\n'.format(obo, idx, label))
+        for idx, label in enumerate(CIDO_PREDICATES):
+            file.write('<{}RO_{:07d}> rdfs:label "{}" .\n'.format(obo, idx, label))
+
+        for _ in range(num_triples):
+            file.write('<{0}CIDO_{1:07d}> <{0}RO_{2:07d}> <{0}CIDO_{3:07d}> .\n'.format(
+                obo, rng.randrange(len(labels)), rng.randrange(len(CIDO_PREDICATES)), rng.randrange(len(labels))))
+
+
+def feature_stage(data: List[str], analyzer: StubAnalyzer, ner_tagger: StubTagger, args) -> Tuple[EntityTracker,
+                                                                                                  PatternTracker]:
+
+    # extraction itself, with the stub models in place of stanza and HunFlair
+    # without dedup, spilling or profiling, so that only the plain extraction path is timed
+    stage_args = copy.copy(args)
+    stage_args.dedup = 'none'
+    stage_args.tracker_budget = None
+    stage_args.profile = None
+
+    entity_tracker, pattern_tracker, _ = extraction(data, stage_args, models=(analyzer, ner_tagger, StubFlairSentence))
+    return entity_tracker, pattern_tracker
+
+
+def measure(function: Callable, repeat: int) -> Tuple[object, float, float]:
+
+    # best time of the repeats, then one more run under tracemalloc for the peak memory, which slows it down
+    times = list()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = function()
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, min(times), peak / (1024 * 1024)
+
+
+def benchmark_scale(num_sent: int, args, path_to_dir: str) -> dict:
+    """
+    Generate a synthetic corpus, parses, entity spans and ontology of the given size, and run each stage on it
+
+    :param num_sent: number of sentences
+    :param args: arguments, with bench_repeat, mark_print and the clustering and ranking arguments
+    :param path_to_dir: folder for the synthetic files
+    :return: dict with, for each stage, seconds, number of items, items per second and peak memory in MB
+    """
+
+    rng = random.Random(num_sent)
+    num_entities = max(20, num_sent // 10)
+
+    sentences = list()
+    spans = dict()
+    parses = dict()
+    for _ in range(num_sent):
+        sentence, sentence_spans = synthetic_sentence(rng, num_entities)
+        text = ' '.join([token.text for token in sentence.tokens])
+        sentences.append(sentence)
+        parses[text] = sentence
+        spans[text] = sentence_spans
+
+    write_vert(sentences, os.path.join(path_to_dir, 'synthetic.vert'), rng)
+    write_cido(num_entities, num_sent, os.path.join(path_to_dir, 'synthetic_cido.ttl'), rng)
+
+    results = dict()
+
+    def record(stage: str, function: Callable, num_items: Callable[[object], int]):
+        result, seconds, peak = measure(function, args.bench_repeat)
+        items = num_items(result)
+        results[stage] = {'seconds': seconds, 'items': items, 'per_second': items / seconds if seconds else 0.0,
+                          'peak_mb': peak}
+        return result
+
+    record('read_data', lambda: read_data(path_to_dir, 'synthetic.vert', num_sent), lambda _: num_sent)
+    data = load_compressed_data(os.path.join(path_to_dir, 'corpus.zipped'))
+
+    entity_tracker, pattern_tracker = record('extract_features', lambda: feature_stage(data, StubAnalyzer(parses),
+                                                                                      StubTagger(spans), args),
+                                             lambda _: len(data))
+
+    def matrix_stage():
+        # the matrix numbers the pairs in the entity tracker, start from an empty numbering each time
+        entity_tracker.pair2idx, entity_tracker.idx2pair = dict(), dict()
+        return pair_pattern_matrix(pattern_tracker, entity_tracker)
+
+    matrix = record('pair_pattern_matrix', matrix_stage, lambda result: result.shape[0])
+
+    def clustering_stage():
+        # a new folder each time, so that the cached distances of an earlier run are not used
+        parameters = {'distance_metric': args.distance_metric,
+                      'linkage': args.linkage,
+                      'distance_threshold': args.distance_threshold,
+                      'n_clusters': None,
+                      'path_to_data_dir': tempfile.mkdtemp(dir=path_to_dir),
+                      'memory_budget': args.memory_budget}
+        return clustering(matrix, parameters)
+
+    clusters = record('clustering', clustering_stage, lambda _: matrix.shape[0])
+    cp_matrix = record('cluster_pattern_matrix', lambda: cluster_pattern_matrix(clusters, matrix, args),
+                       lambda _: matrix.shape[0])
+
+    record('get_ranked_patterns', lambda: [get_ranked_patterns(cp_matrix[cid], pattern_tracker)
+                                           for cid in range(clusters.n_clusters_)],
+           lambda _: clusters.n_clusters_)
+
+    path_to_cido = os.path.join(path_to_dir, 'synthetic_cido.ttl')
+    record('get_cido_triples', lambda: get_cido_triples(entity_tracker, args.normalised_match, path_to_cido),
+           lambda cido: len({(pair, relation) for pair, relations in cido.pair2relation.items()
+                             for relation in relations}))
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+
+    # slower or bigger than the baseline by more than the tolerance, ignoring differences too small to measure
+    regressions = list()
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is None:
+                continue
+
+            if result['seconds'] > base['seconds'] * (1 + tolerance) and result['seconds'] - base['seconds'] > 0.01:
+                regressions.append('{} sentences, {}: {:.3f}s against {:.3f}s'.format(
+                    scale, stage, result['seconds'], base['seconds']))
+            if result['peak_mb'] > base['peak_mb'] * (1 + tolerance) and result['peak_mb'] - base['peak_mb'] > 1:
+                regressions.append('{} sentences, {}: {:.1f} MB against {:.1f} MB'.format(
+                    scale, stage, result['peak_mb'], base['peak_mb']))
+
+    return regressions
+
+
+def run_benchmark(args) -> List[str]:
+
+    path_to_baseline = args.baseline or os.path.join(args.path_to_data_dir, 'benchmark_baseline.json')
+    path_to_dir = tempfile.mkdtemp(prefix='benchmark_')
+
+    results = dict()
+    try:
+        for num_sent in args.bench_scales:
+            print('Benchmarking {} synthetic sentences...'.format(num_sent))
+            results[str(num_sent)] = benchmark_scale(num_sent, args, path_to_dir)
+    finally:
+        shutil.rmtree(path_to_dir, ignore_errors=True)
+
+    print('=' * 50)
+    print('{:>8} {:<24} {:>10} {:>8} {:>12} {:>10}'.format('scale', 'stage', 'seconds', 'items', 'items/s', 'peak MB'))
+    for scale, stages in results.items():
+        for stage in STAGES:
+            result = stages[stage]
+            print('{:>8} {:<24} {:>10.4f} {:>8} {:>12.1f} {:>10.2f}'.format(
+                scale, stage, result['seconds'], result['items'], result['per_second'], result['peak_mb']))
+    print('=' * 50)
+
+    regressions = list()
+    if os.path.isfile(path_to_baseline):
+        with open(path_to_baseline, 'r', encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        print('Compared with baseline', path_to_baseline)
+        print('Regressions:', len(regressions))
+        for regression in regressions:
+            print('...', regression)
+        print('=' * 50)
+
+    if args.save_baseline:
+        with open(path_to_baseline, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print('Baseline saved to', path_to_baseline)
+
+    return regressions
@@ -1,61 +1,101 @@
 import numpy as np
-from typing import Tuple
-from sklearn.feature_extraction.text import TfidfTransformer
-from sklearn.cluster import AgglomerativeClustering
+from typing import Tuple, Union
+from collections import Counter
+from scipy import sparse
 from entity_extraction import EntityTracker
 from feature_extraction import PatternTracker
 
 
-def pair_pattern_matrix(pattern_tracker: PatternTracker, entity_tracker: EntityTracker) -> np.ndarray:
+class HierarchicalClusters:
+
+    def __init__(self, labels: np.ndarray, linkage_matrix: np.ndarray):
+
+        # same attribute names as sklearn AgglomerativeClustering
+        self.labels_ = labels
+        self.n_clusters_ = int(labels.max()) + 1 if len(labels) else 0
+        self.linkage_matrix = linkage_matrix
+
+
+def pair_pattern_matrix(pattern_tracker: PatternTracker, entity_tracker: EntityTracker) -> sparse.csr_matrix:
 
     # pairs as rows and patterns as columns with cells as co-occurrence counts of patterns
-    matrix = []
-    highest_count = 0
+    rows = list()
+    cols = list()
+    counts = list()
 
     for pair, patterns in pattern_tracker.pairs2patterns.items():
 
         if patterns:
-            feature_vector = [0] * len(pattern_tracker.patterns)
             entity_tracker.add_pair_idx(pair)
+            feature_counts = Counter(pattern_tracker.patterns.index(pattern) for pattern in patterns)
 
-            for pattern in patterns:
-                feature_vector[pattern_tracker.patterns.index(pattern)] += 1
-
-            matrix.append(feature_vector)
+            rows.extend([entity_tracker.pair2idx[pair]] * len(feature_counts))
+            cols.extend(feature_counts.keys())
+            counts.extend(feature_counts.values())
 
-            max_count = feature_vector[np.array(feature_vector).argmax()]
-            if max_count > highest_count:
-                highest_count = max_count
+    matrix = sparse.csr_matrix((counts, (rows, cols)), shape=(len(entity_tracker.pair2idx),
+                                                               len(pattern_tracker.patterns)))
 
     print('=' * 50)
-    print('Highest count of features:', highest_count)
+    print('Highest count of features:', max(counts) if counts else 0)
     print('=' * 50)
 
-    return np.array(matrix)
+    return matrix
 
 
-def cluster_pattern_matrix(clusters: AgglomerativeClustering, pp_matrix: np.ndarray, args) -> np.ndarray:
+def cluster_pattern_matrix(clusters: HierarchicalClusters, pp_matrix: Union[np.ndarray, sparse.spmatrix],
+                           args) -> sparse.csr_matrix:
 
-    cp_matrix = np.zeros((clusters.n_clusters_, pp_matrix.shape[1]))
+    # cluster-indicator matrix with clusters as rows and pairs as columns, cell is 1 if the pair belongs to the cluster
+    labels = np.asarray(clusters.labels_)
+    indicator = sparse.csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))),
+                                  shape=(clusters.n_clusters_, len(labels)))
 
-    for idx, cluster_id in enumerate(clusters.labels_):
-        cp_matrix[cluster_id] += pp_matrix[idx]
+    # summing pattern counts of all pairs in a cluster is then one sparse product
+    cp_matrix = indicator @ sparse.csr_matrix(pp_matrix)
 
     if args.ranked_metric == 'tfidf':
+        from sklearn.feature_extraction.text import TfidfTransformer
         cp_matrix = TfidfTransformer().fit_transform(cp_matrix)
 
+    # csr so that each cluster row can be sliced on its own without densifying the matrix
+    cp_matrix = sparse.csr_matrix(cp_matrix)
+    cp_matrix.sort_indices()
+
     return cp_matrix
 
 
-def clustering(matrix: np.ndarray, parameters: dict) -> AgglomerativeClustering:
+def clustering(matrix: Union[np.ndarray, sparse.spmatrix], parameters: dict) -> HierarchicalClusters:
 
-    clusters = AgglomerativeClustering(affinity=parameters['distance_metric'],
-                                       linkage=parameters['linkage'],
-                                       distance_threshold=parameters['distance_threshold'],
-                                       n_clusters=parameters['n_clusters'])
-    clusters.fit(matrix)
+    # sklearn and scipy.cluster are only needed by the clustering stage
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from distances import get_distances
 
-    return clusters
+    if parameters['linkage'] == 'ward' and parameters['distance_metric'] != 'euclidean':
+        raise ValueError('ward linkage only works with euclidean distances, got {}'.format(
+            parameters['distance_metric']))
+
+    # a single pair, or none, is its own cluster, there is no distance to compute or cache
+    n_rows = matrix.shape[0]
+    if n_rows < 2:
+        return HierarchicalClusters(np.ones(n_rows, dtype=int) - 1, np.empty((0, 4)))
+
+    # condensed distance matrix, computed once per matrix and metric and reused afterwards
+    distances = get_distances(matrix, parameters['distance_metric'],
+                              parameters['path_to_data_dir'], parameters['memory_budget'])
+
+    # the metric is already applied in the condensed matrix, linkage only needs the method
+    tree = linkage(distances, method=parameters['linkage'])
+
+    # cut the tree at the threshold or into a fixed number of clusters, labels start from 0
+    if parameters['n_clusters'] is not None:
+        labels = fcluster(tree, t=parameters['n_clusters'], criterion='maxclust')
+    else:
+        # fcluster merges at distances <= t, while clusters were never merged at the threshold itself before,
+        # which matters for the exact ties of manhattan and euclidean distances between count vectors
+        labels = fcluster(tree, t=np.nextafter(parameters['distance_threshold'], -np.inf), criterion='distance')
+
+    return HierarchicalClusters(labels - 1, tree)
 
 
 def build_cid2pidx(clusters: dict):
@@ -72,26 +112,29 @@ def build_cid2pidx(clusters: dict):
     return cid2pidx
 
 
-def get_ranked_patterns(vector: np.ndarray, pattern_tracker: PatternTracker) -> Tuple[list, list, list]:
-
-    patterns = list()
-    indexes = list()
-    counts = list()
-    scores = list(vector)
+def get_ranked_patterns(vector: Union[np.ndarray, sparse.spmatrix],
+                        pattern_tracker: PatternTracker) -> Tuple[list, list, list]:
 
-    while len(patterns) < 10:
-        highest_score_idx = scores.index(max(scores))
-        counts.append(max(scores))
-        scores[highest_score_idx] = 0.0
+    # vector is one row of the cluster-pattern matrix, only its non-zero cells can be ranked
+    if sparse.issparse(vector):
+        vector = sparse.csr_matrix(vector)
+        vector.sort_indices()
+        indexes, scores = vector.indices, vector.data
+    else:
+        vector = np.asarray(vector).ravel()
+        indexes = np.flatnonzero(vector)
+        scores = vector[indexes]
 
-        pattern = pattern_tracker.patterns[highest_score_idx]
-        patterns.append(pattern)
-        indexes.append(highest_score_idx)
+    # top 10 scores, ties broken by lower pattern index
+    top = np.argsort(-scores, kind='stable')[:10]
+    indexes = indexes[top].tolist()
+    counts = scores[top].tolist()
+    patterns = [pattern_tracker.patterns[idx] for idx in indexes]
 
     return patterns, indexes, counts
 
 
-def print_cluster_info(clusters: AgglomerativeClustering) -> None:
+def print_cluster_info(clusters: HierarchicalClusters) -> None:
 
     print('\nNumber of clusters', clusters.n_clusters_)
     print('=' * 50)
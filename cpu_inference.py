@@ -0,0 +1,135 @@
+from __future__ import annotations
+import copy
+import time
+import threading
+from typing import List, Tuple
+
+import torch
+import flair
+
+from entity_extraction import extract_entity
+
+
+# sentences tagged before timing the taggers in the quantisation check
+WARM_UP_SENTENCES = 10
+
+
+# torch.inference_mode only exists from torch 1.9, no_grad does the same job before that
+inference_context = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def set_interop_threads(inter_threads: int) -> None:
+
+    # can only be set once, before any inter-op parallel work has started
+    if inter_threads:
+        try:
+            torch.set_num_interop_threads(inter_threads)
+        except RuntimeError:
+            print('Inter-op threads already set, keeping', torch.get_num_interop_threads())
+
+
+class CPUModel:
+    """
+    Run a model on CPU without autograd, with its own number of intra-op threads in each worker thread
+    Works for the stanza pipeline (called directly) and the flair tagger (called with predict)
+    """
+
+    def __init__(self, model, intra_threads: int):
+
+        self.model = model
+        self.intra_threads = intra_threads
+        self.configured = threading.local()
+
+    def set_threads(self):
+
+        # the intra-op thread count is kept per thread, so set it the first time each worker uses the model
+        if self.intra_threads and not getattr(self.configured, 'done', False):
+            torch.set_num_threads(self.intra_threads)
+            self.configured.done = True
+
+    def __call__(self, *args, **kwargs):
+        self.set_threads()
+        with inference_context():
+            return self.model(*args, **kwargs)
+
+    def predict(self, *args, **kwargs):
+        self.set_threads()
+        with inference_context():
+            return self.model.predict(*args, **kwargs)
+
+
+def quantize_tagger(ner_tagger, inplace: bool = True):
+    """
+    Apply dynamic int8 quantisation to LSTM and linear layers of every sequence tagger in a flair MultiTagger
+    Weights are stored in int8 and activations quantised on the fly, which only helps on CPU
+
+    :param ner_tagger: flair MultiTagger, e.g. hunflair
+    :param inplace: quantise the given tagger, or a copy of it
+    :return: the quantised tagger
+    """
+
+    if not inplace:
+        ner_tagger = copy.deepcopy(ner_tagger)
+
+    for name, tagger in ner_tagger.name_to_tagger.items():
+        ner_tagger.name_to_tagger[name] = torch.quantization.quantize_dynamic(
+            tagger, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return ner_tagger
+
+
+def tag_entities(sentences: List[str], ner_tagger) -> Tuple[List[set], float]:
+
+    entities = list()
+    start = time.perf_counter()
+
+    with inference_context():
+        for sentence in sentences:
+            sentence = flair.data.Sentence(sentence)
+            ner_tagger.predict(sentence)
+            entities.append(set(extract_entity(sentence)))
+
+    return entities, time.perf_counter() - start
+
+
+def check_quantization(sentences: List[str], ner_tagger, min_f1: float) -> bool:
+    """
+    Compare entity spans of the quantised tagger against the original one on sample sentences
+    Spans of the original tagger are taken as gold, a span counts only if start, end and tag all match
+
+    :param sentences: sample sentences of the corpus
+    :param ner_tagger: the original, unquantised tagger
+    :param min_f1: lowest F1 score at which the quantised tagger is accepted
+    :return: whether the quantised tagger is accepted
+    """
+
+    quantized_tagger = quantize_tagger(ner_tagger, inplace=False)
+
+    # one untimed pass over a few sentences per tagger, so the first timed one does not also pay for the warm-up
+    tag_entities(sentences[:WARM_UP_SENTENCES], ner_tagger)
+    tag_entities(sentences[:WARM_UP_SENTENCES], quantized_tagger)
+
+    gold, gold_time = tag_entities(sentences, ner_tagger)
+    predicted, predicted_time = tag_entities(sentences, quantized_tagger)
+
+    num_gold = sum(len(spans) for spans in gold)
+    num_predicted = sum(len(spans) for spans in predicted)
+    num_correct = sum(len(gold_spans & predicted_spans) for gold_spans, predicted_spans in zip(gold, predicted))
+    num_same = sum(1 for gold_spans, predicted_spans in zip(gold, predicted) if gold_spans == predicted_spans)
+
+    precision = num_correct / num_predicted if num_predicted else 1.0
+    recall = num_correct / num_gold if num_gold else 1.0
+    f1_score = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    accepted = f1_score >= min_f1
+
+    print('=' * 50)
+    print('Quantisation check on {} sentences'.format(len(sentences)))
+    print('Entity spans original / quantised / matching: {} / {} / {}'.format(num_gold, num_predicted, num_correct))
+    print('Sentences with identical spans: {} of {}'.format(num_same, len(sentences)))
+    print('Precision, Recall, and F1 scores respectively: {}, {}, {}'.format(precision, recall, f1_score))
+    print('Tagging time original / quantised: {:.2f}s / {:.2f}s, speedup {:.2f}x'.format(
+        gold_time, predicted_time, gold_time / predicted_time if predicted_time > 0 else 0.0))
+    print('Quantised tagger {} (F1 threshold {})'.format('ACCEPTED' if accepted else 'REJECTED', min_f1))
+    print('=' * 50)
+
+    return accepted
@@ -0,0 +1,113 @@
+import zlib
+import hashlib
+import numpy as np
+from typing import List, Set
+
+
+# Mersenne prime for the universal hash functions of MinHash
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def deduplicate(data: List[str], mode: str = 'exact', threshold: float = 0.9,
+                num_perm: int = 64, bands: int = 16, shingle_size: int = 3) -> List[int]:
+    """
+    Find duplicate lines, so that the models only run on one copy of each
+    Exact duplicates are found by hash, near duplicates by MinHash signatures of token shingles,
+    bucketed with LSH so that each line is only compared with likely candidates
+
+    :param data: list of lines of the corpus
+    :param mode: 'exact' or 'near', which also drops exact duplicates
+    :param threshold: lowest estimated Jaccard similarity of shingles for a near duplicate
+    :param num_perm: number of hash functions in a MinHash signature
+    :param bands: number of LSH bands, num_perm must be a multiple of it
+    :param shingle_size: number of tokens in a shingle
+    :return: for each line, the index of its canonical line, i.e. its own index if it is not a duplicate
+    """
+
+    canonical = list(range(len(data)))
+    seen = dict()
+
+    for idx, line in enumerate(data):
+        # same tokens with different spacing count as the same line
+        digest = hashlib.md5(' '.join(line.split()).encode('utf-8')).digest()
+
+        if digest in seen:
+            canonical[idx] = seen[digest]
+        else:
+            seen[digest] = idx
+
+    num_exact = sum(1 for idx, canon in enumerate(canonical) if idx != canon)
+    if mode == 'near':
+        near_duplicates(data, canonical, threshold, num_perm, bands, shingle_size)
+    num_near = sum(1 for idx, canon in enumerate(canonical) if idx != canon) - num_exact
+
+    print('=' * 50)
+    print('Number of lines:', len(data))
+    print('Exact duplicates skipped:', num_exact)
+    if mode == 'near':
+        print('Near duplicates skipped:', num_near)
+    print('=' * 50)
+
+    return canonical
+
+
+def get_shingles(line: str, shingle_size: int) -> Set[str]:
+
+    tokens = line.lower().split()
+    if len(tokens) <= shingle_size:
+        return {' '.join(tokens)}
+
+    return {' '.join(tokens[idx:idx + shingle_size]) for idx in range(len(tokens) - shingle_size + 1)}
+
+
+def minhash(shingles: Set[str], coefficients: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+
+    # crc32 rather than hash(), which changes between runs
+    hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.int64) % MERSENNE_PRIME
+
+    # one row per shingle, one column per hash function, all values below 2^62 so no overflow
+    return ((np.outer(hashes, coefficients) + offsets) % MERSENNE_PRIME).min(axis=0)
+
+
+def near_duplicates(data: List[str], canonical: List[int], threshold: float,
+                    num_perm: int, bands: int, shingle_size: int) -> None:
+
+    if num_perm % bands != 0:
+        raise ValueError('num_perm ({}) must be a multiple of bands ({})'.format(num_perm, bands))
+    rows = num_perm // bands
+
+    # fixed seed, so the same corpus always gives the same canonical lines
+    generator = np.random.RandomState(1)
+    coefficients = generator.randint(1, MERSENNE_PRIME, size=num_perm).astype(np.int64)
+    offsets = generator.randint(0, MERSENNE_PRIME, size=num_perm).astype(np.int64)
+
+    signatures = dict()  # signatures of canonical lines only
+    buckets = dict()  # { (band, band signature) : [canonical line idx] }
+
+    for idx, line in enumerate(data):
+        if canonical[idx] != idx:
+            continue
+
+        signature = minhash(get_shingles(line, shingle_size), coefficients, offsets)
+        keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(bands)]
+
+        # lines sharing at least one band are candidates, the share of equal hashes estimates their similarity
+        match = None
+        for key in keys:
+            for candidate in buckets.get(key, []):
+                if np.mean(signatures[candidate] == signature) >= threshold:
+                    match = candidate
+                    break
+            if match is not None:
+                break
+
+        if match is not None:
+            canonical[idx] = match
+        else:
+            signatures[idx] = signature
+            for key in keys:
+                buckets.setdefault(key, []).append(idx)
+
+    # exact duplicates of a line now marked as near duplicate point to the same canonical line
+    for idx in range(len(canonical)):
+        canonical[idx] = canonical[canonical[idx]]
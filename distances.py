@@ -0,0 +1,129 @@
+import os
+import hashlib
+import numpy as np
+from typing import Union
+from scipy import sparse
+from sklearn.preprocessing import normalize
+from sklearn.metrics.pairwise import manhattan_distances
+
+
+def matrix_fingerprint(matrix: Union[np.ndarray, sparse.spmatrix]) -> str:
+
+    # hash of the shape and the non-zero cells, so same matrix --> same key no matter how it was stored
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+
+    digest = hashlib.sha1()
+    digest.update(np.asarray(matrix.shape, dtype=np.int64).tobytes())
+    digest.update(matrix.indptr.astype(np.int64).tobytes())
+    digest.update(matrix.indices.astype(np.int64).tobytes())
+    digest.update(matrix.data.tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def condensed_size(n_rows: int) -> int:
+    return n_rows * (n_rows - 1) // 2
+
+
+def condensed_offset(row: int, n_rows: int) -> int:
+
+    # position in the condensed matrix of the distance between row and row + 1
+    return row * (2 * n_rows - row - 1) // 2
+
+
+def chunk_size(n_rows: int, memory_budget: int) -> int:
+
+    # a chunk of rows needs a dense block of (chunk x n_rows) float64 plus temporaries of the same size
+    row_bytes = n_rows * np.dtype(np.float64).itemsize * 4
+    return int(max(1, min(n_rows, (memory_budget * 1024 * 1024) // max(row_bytes, 1))))
+
+
+def distance_block(chunk: sparse.csr_matrix, matrix: sparse.csr_matrix, metric: str,
+                   chunk_sq: np.ndarray, matrix_sq: np.ndarray) -> np.ndarray:
+
+    if metric == 'cosine':
+        # rows are already normalised, so the dot product is the cosine similarity
+        block = 1.0 - (chunk @ matrix.T).toarray()
+        np.clip(block, 0.0, 2.0, out=block)
+
+    elif metric == 'euclidean':
+        block = (chunk @ matrix.T).toarray()
+        block *= -2.0
+        block += chunk_sq[:, np.newaxis]
+        block += matrix_sq[np.newaxis, :]
+        np.maximum(block, 0.0, out=block)
+        np.sqrt(block, out=block)
+
+    elif metric == 'manhattan':
+        block = manhattan_distances(chunk, matrix)
+
+    else:
+        raise ValueError('Unknown distance metric: {}'.format(metric))
+
+    return block
+
+
+def compute_distances(matrix: Union[np.ndarray, sparse.spmatrix], metric: str,
+                      path_to_file: str, memory_budget: int) -> np.memmap:
+    """
+    Compute the condensed pairwise distance matrix of the rows, chunk by chunk, into a memory-mapped file
+    The layout is the same as scipy.spatial.distance.pdist, i.e. the upper triangle read row by row
+
+    :param matrix: pair-pattern matrix, pairs as rows
+    :param metric: cosine, euclidean or manhattan
+    :param path_to_file: file to store the condensed matrix
+    :param memory_budget: maximum size in MB of the dense blocks held in memory at once
+    :return: the condensed matrix, opened copy-on-write so the cached file is never modified
+    """
+
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+    n_rows = matrix.shape[0]
+
+    if metric == 'cosine':
+        matrix = normalize(matrix, norm='l2', axis=1, copy=True)
+    sq_norms = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+
+    # write to a temporary file first so a half-written cache is never picked up
+    tmp_path = path_to_file + '.tmp'
+    distances = np.memmap(tmp_path, dtype=np.float64, mode='w+', shape=(condensed_size(n_rows),))
+
+    step = chunk_size(n_rows, memory_budget)
+    for start in range(0, n_rows - 1, step):
+        end = min(start + step, n_rows)
+
+        # only distances to rows from `start` onwards are needed for the upper triangle
+        block = distance_block(matrix[start:end], matrix[start:], metric, sq_norms[start:end], sq_norms[start:])
+
+        for row in range(start, end):
+            offset = condensed_offset(row, n_rows)
+            distances[offset:offset + n_rows - row - 1] = block[row - start, row - start + 1:]
+
+    distances.flush()
+    del distances
+    os.replace(tmp_path, path_to_file)
+
+    return np.memmap(path_to_file, dtype=np.float64, mode='c', shape=(condensed_size(n_rows),))
+
+
+def get_distances(matrix: Union[np.ndarray, sparse.spmatrix], metric: str,
+                  path_to_data_dir: str, memory_budget: int) -> np.memmap:
+
+    # distances are cached under data dir, keyed by matrix fingerprint and metric
+    # so that runs with another linkage or threshold can reuse them
+    cache_dir = os.path.join(path_to_data_dir, 'distances')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    n_rows = matrix.shape[0]
+    if n_rows < 2:
+        raise ValueError('Pairwise distances need at least 2 rows, got {}'.format(n_rows))
+
+    path_to_file = os.path.join(cache_dir, '{}_{}.dist'.format(matrix_fingerprint(matrix), metric))
+
+    if os.path.isfile(path_to_file):
+        print('Reusing distance matrix from', path_to_file)
+        return np.memmap(path_to_file, dtype=np.float64, mode='c', shape=(condensed_size(n_rows),))
+
+    print('Computing {} distance matrix to {}'.format(metric, path_to_file))
+    return compute_distances(matrix, metric, path_to_file, memory_budget)
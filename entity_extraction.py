@@ -1,6 +1,14 @@
-from typing import List, Tuple
+from __future__ import annotations
+import re
+from typing import List, Tuple, TYPE_CHECKING
 from collections import Counter
-import flair
+
+# flair is only needed for type hints here, so unpickling trackers does not load torch
+if TYPE_CHECKING:
+    import flair
+
+
+COVID_TERMS = frozenset(['covid-19', 'covid', 'covid19', 'corona', 'coronavirus', 'sars-cov-2', 'coronaviruses'])
 
 
 class EntityTracker:
@@ -18,6 +26,17 @@ class EntityTracker:
         self.entity2type = dict()
         self.type2entity = dict()
 
+    def clear(self):
+
+        # forget everything tracked so far, e.g. after it was written to disk
+        self.entity_pairs.clear()
+        self.covid_pairs.clear()
+        self.occurrence_counter.clear()
+        self.pair2idx.clear()
+        self.idx2pair.clear()
+        self.entity2type.clear()
+        self.type2entity.clear()
+
     def update(self, pair: Tuple[str, str], type1: str, type2: str):
         self.add_pair(pair)
         self.add_entity_type(pair[0], type1.upper())
@@ -30,6 +49,12 @@ class EntityTracker:
         self.entity_pairs.add(pair_tuple)
         self.occurrence_counter.update([pair_tuple])
 
+    def add_occurrences(self, pairs: List[Tuple[str, str]], count: int):
+
+        # credit pairs of a sentence whose duplicates were skipped before running the models
+        for pair in pairs:
+            self.occurrence_counter[pair] += count
+
     def add_pair_idx(self, pair: Tuple[str, str]):
         self.pair2idx[pair] = len(self.pair2idx)
         self.idx2pair[len(self.idx2pair)] = pair
@@ -80,8 +105,7 @@ def extract_entity(sentence: flair.data.Sentence) -> List[tuple]:
 
 def covid_terms(token_idx: int, sentence: List[str]) -> bool:
 
-    terms = ['covid-19', 'covid', 'covid19', 'corona', 'coronavirus', 'sars-cov-2', 'coronaviruses']
-    return True if sentence[token_idx].lower() in terms else False
+    return True if sentence[token_idx].lower() in COVID_TERMS else False
 
 
 def get_covid_entity(sentence: str) -> List[tuple]:
@@ -132,6 +156,20 @@ def get_entity_text(entity_tuple: tuple, sentence: str) -> str:
     return ' '.join(sentence[entity_tuple[0]-1:entity_tuple[1]]).lower().strip().replace(' : ', ':').replace(' - ', '-')
 
 
+def normalise_entity(text: str) -> str:
+    """
+    Map case, hyphen and spacing variants of an entity to one form
+    e.g. 'SARS-CoV-2', 'sars - cov - 2' and 'sars_cov 2' all become 'sars cov 2'
+
+    :param text: entity text, from our data or a CIDO label
+    :return: the normalised form
+    """
+
+    text = text.lower().replace('_', ' ').replace('-', ' ')
+    text = re.sub(r'\s*:\s*', ':', text)
+    return ' '.join(text.split())
+
+
 def nested_entities(pair: Tuple[tuple, tuple]) -> bool:
 
     start_ne1 = pair[0][0]
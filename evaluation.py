@@ -1,9 +1,12 @@
-from typing import Tuple
-from rdflib import URIRef, ConjunctiveGraph
+from __future__ import annotations
+from typing import Tuple, Set, Iterable, TYPE_CHECKING
 import bcubed
 
-from entity_extraction import EntityTracker
-from read_datasets import load_cido
+from entity_extraction import EntityTracker, COVID_TERMS, normalise_entity
+from read_datasets import load_cido, CIDO_URL
+
+if TYPE_CHECKING:
+    from rdflib import URIRef, ConjunctiveGraph
 
 
 class CIDOTriple:
@@ -27,6 +30,15 @@ class CIDOTriple:
         # cido pairs which are same as pairs obtained from our data set
         self.identity_pairs = set()
 
+        # entity text in our data --> uri of the matching cido node
+        self.entity2uri = dict()
+
+    def __setstate__(self, state: dict):
+
+        # pickles written before entity2uri was added have no uris
+        state.setdefault('entity2uri', dict())
+        self.__dict__.update(state)
+
     def add_entity(self, entity: str, add_all: bool):
         self.all_entities.add(entity) if add_all else self.entities.add(entity)
 
@@ -52,39 +64,101 @@ class CIDOTriple:
             self.pair2relation[pair].append(relation)
 
 
-def get_cido_triples(entity_tracker: EntityTracker) -> CIDOTriple:
+def get_cido_triples(entity_tracker: EntityTracker, normalised: bool = False,
+                     path_to_cido: str = CIDO_URL) -> CIDOTriple:
 
-    graph = load_cido()
+    from rdflib import URIRef
+
+    graph = load_cido(path_to_cido)
     cido = CIDOTriple()
 
-    for subj, pred, obj in graph:
+    triples = [(subj, pred, obj) for subj, pred, obj in graph if type(subj) == type(pred) == type(obj) == URIRef]
+
+    # resolve the label of each node only once, then work on label triples
+    labels = resolve_labels({node for triple in triples for node in triple}, graph)
+    entity_nodes = {triple[0] for triple in triples} | {triple[2] for triple in triples}
+    triples = [(labels[subj], labels[pred], labels[obj]) for subj, pred, obj in triples]
+
+    # CIDO entities found in our data, mapped to the entity text used in our trackers
+    aligned = align_entities({triple[0] for triple in triples} | {triple[2] for triple in triples},
+                             entity_tracker, normalised)
+    covid = {label for label in aligned if covid_term(label)}
 
-        if type(subj) == type(pred) == type(obj) == URIRef:
-            subj = get_value(subj, graph)
-            pred = get_value(pred, graph)
-            obj = get_value(obj, graph)
+    # keep the uri of matched entities, so that an export of our graph can reuse them
+    for node in sorted(entity_nodes):
+        if labels[node] in aligned:
+            cido.entity2uri.setdefault(aligned[labels[node]], str(node))
 
-            if entity_exists(subj, entity_tracker) and entity_exists(obj, entity_tracker):
-                cido.update_pair_relation((subj, obj), pred)
+    for subj, pred, obj in triples:
 
-                if covid_term(subj) or covid_term(obj):
-                    cido.covid_pairs.add((subj, obj))
+        if subj in aligned and obj in aligned:
+            cido.update_pair_relation((subj, obj), pred)
 
-                if pair_coexist((subj, obj), entity_tracker):
-                    cido.add_id_pair((subj, obj))
+        elif subj in aligned:
+            cido.add_entity(subj, add_all=False)
 
-            elif entity_exists(subj, entity_tracker):
-                cido.add_entity(subj, add_all=False)
+        elif obj in aligned:
+            cido.add_entity(obj, add_all=False)
 
-            elif entity_exists(obj, entity_tracker):
-                cido.add_entity(obj, add_all=False)
+        cido.update_pair_relation((subj, obj), pred, add_all=True)
+
+    cido.covid_pairs = {pair for pair in cido.pairs if pair[0] in covid or pair[1] in covid}
+    cido.all_covid_pairs = {pair for pair in cido.all_pairs if covid_term(pair[0]) or covid_term(pair[1])}
+
+    # cido pairs which are also pairs in our data, kept in the form of our data so they can be looked up in trackers
+    # only pairs with patterns have a row in the pair-pattern matrix, and so a cluster to evaluate
+    for pair in cido.pairs:
+        our_pair = (aligned[pair[0]], aligned[pair[1]])
+
+        if our_pair in entity_tracker.pair2idx:
+            cido.add_id_pair(our_pair)
+
+            # several cido labels can map to the same pair of ours, keep each relation once
+            if our_pair != pair:
+                relations = cido.pair2relation.setdefault(our_pair, [])
+                for relation in cido.pair2relation[pair]:
+                    if relation not in relations:
+                        relations.append(relation)
 
-            cido.update_pair_relation((subj, obj), pred, add_all=True)
-            if covid_term(subj) or covid_term(obj):
-                cido.all_covid_pairs.add((subj, obj))
     return cido
 
 
+def resolve_labels(nodes: Iterable[URIRef], graph: ConjunctiveGraph) -> dict:
+    return {node: get_value(node, graph) for node in nodes}
+
+
+def align_entities(labels: Set[str], entity_tracker: EntityTracker, normalised: bool) -> dict:
+    """
+    Match CIDO labels against entities in our data, by lowercase label
+    and optionally by normalised form (case, hyphen and spacing variants)
+
+    :param labels: set of CIDO labels
+    :param entity_tracker: the entity tracker of our data
+    :param normalised: whether to also match on normalised forms
+    :return: dict with matched labels as keys and entity text in our data as values
+    """
+
+    aligned = dict()
+
+    # covid terms always count as existing entities
+    lowered = {label: label.lower() for label in labels}
+    for label, lower in lowered.items():
+        if lower in entity_tracker.entity2type or lower in COVID_TERMS:
+            aligned[label] = lower
+
+    if normalised:
+        norm2entity = dict()
+        for entity in entity_tracker.entity2type:
+            norm2entity.setdefault(normalise_entity(entity), entity)
+
+        for label in labels - aligned.keys():
+            entity = norm2entity.get(normalise_entity(label))
+            if entity is not None:
+                aligned[label] = entity
+
+    return aligned
+
+
 def get_value(node: URIRef, graph: ConjunctiveGraph) -> str:
     try:
         node = graph.label(node).value if graph.label(node) else graph.qname(node)
@@ -115,17 +189,8 @@ def print_cido_info(cido: CIDOTriple):
     print('\nCido relations', list(cido.all_relations))
 
 
-def entity_exists(entity: str, entity_tracker: EntityTracker) -> bool:
-    return True if covid_term(entity) or entity.lower() in entity_tracker.entity2type else False
-
-
 def covid_term(entity: str) -> bool:
-    covid_terms = ['covid-19', 'covid', 'covid19', 'corona', 'coronavirus', 'sars-cov-2', 'coronaviruses']
-    return True if entity.lower() in covid_terms else False
-
-
-def pair_coexist(pair: tuple, entity_tracker: EntityTracker) -> bool:
-    return True if pair in entity_tracker.entity_pairs else False
+    return True if entity.lower() in COVID_TERMS else False
 
 
 def build_eval_dicts(clusters: dict, cido: CIDOTriple,
@@ -1,26 +1,75 @@
-import stanza
-from flair.models import MultiTagger
+from __future__ import annotations
+import os
+from collections import Counter
+from contextlib import nullcontext
 
 from feature_extraction import *
 from entity_extraction import *
-from evaluation import *
+from timing import startup_timer
+from scipy import sparse
+from clustering import pair_pattern_matrix
 
 
-def load_models():
+def stanza_models_exist(lang: str = 'en', package: str = 'craft', model_dir: str = None) -> bool:
 
-    # load tagger from flair
-    ner_tagger = MultiTagger.load("hunflair")
+    from stanza.resources.common import DEFAULT_MODEL_DIR
+    model_dir = model_dir or DEFAULT_MODEL_DIR
+
+    # models of the processors used by the pipeline, plus the pretrained word vectors
+    processors = ['tokenize', 'pos', 'lemma', 'depparse', 'pretrain']
+
+    paths = [os.path.join(model_dir, 'resources.json')]
+    paths.extend([os.path.join(model_dir, lang, processor, package + '.pt') for processor in processors])
+
+    return all(os.path.isfile(path) for path in paths)
+
+
+def load_models(args=None):
+
+    # the models are only imported here, so that feature extraction and tracker updates can run without them
+    with startup_timer.measure('extract', 'import models'):
+        import flair
+        import stanza
+        import torch
+        from flair.models import MultiTagger
+
+    cpu_inference = args is not None and args.cpu_inference
+    if cpu_inference:
+        from cpu_inference import CPUModel, quantize_tagger, set_interop_threads
+
+        flair.device = torch.device('cpu')
+        set_interop_threads(args.inter_threads)
+
+    # load tagger from flair, it is read from the local flair cache if already downloaded
+    with startup_timer.measure('extract', 'load hunflair'):
+        ner_tagger = MultiTagger.load("hunflair")
 
     # load syntax analyzer, including dependency parser
-    stanza.download('en', package='craft')
-    analyzer = stanza.Pipeline('en', package='craft')
+    # only download when the models are not installed locally, to avoid network calls on every run
+    with startup_timer.measure('extract', 'load stanza'):
+        if not stanza_models_exist('en', package='craft'):
+            stanza.download('en', package='craft')
+        analyzer = stanza.Pipeline('en', package='craft', use_gpu=not cpu_inference)
+
+    if cpu_inference:
+        if args.quantize:
+            with startup_timer.measure('extract', 'quantize hunflair'):
+                ner_tagger = quantize_tagger(ner_tagger)
+
+        # both models then run without autograd and with the given number of threads per worker
+        analyzer = CPUModel(analyzer, args.intra_threads)
+        ner_tagger = CPUModel(ner_tagger, args.intra_threads)
 
     return analyzer, ner_tagger
 
 
-def ner_extract(sentence: str, ner_tagger) -> List[tuple]:
+def ner_extract(sentence: str, ner_tagger, sentence_class=None) -> List[tuple]:
 
-    sentence = flair.data.Sentence(sentence)
+    # the benchmark gives a stand-in for the flair Sentence, so that it runs without flair
+    if sentence_class is None:
+        from flair.data import Sentence as sentence_class
+
+    sentence = sentence_class(sentence)
     ner_tagger.predict(sentence)  # predict NER tags
 
     # extract entities of current sentence
@@ -28,12 +77,15 @@ def ner_extract(sentence: str, ner_tagger) -> List[tuple]:
     return extract_entity(sentence)
 
 
-def pattern_extract(sent_entities: List[tuple], sentence: str, sent_parsed: Sentence,
-                    entity_tracker: EntityTracker, pattern_tracker: PatternTracker, printing: bool) -> None:
+def pair_patterns(sent_entities: List[tuple], sentence: str, sent_parsed: Sentence,
+                  printing: bool) -> List[Tuple[Tuple[str, str], str, str, List[Set[str]]]]:
 
     # get each pair
     # extract patterns / patterns
     # each feature is a set of tokens / strings
+    # trackers are not touched here, so this can run apart from the tracker updates
+    results = list()
+
     for i in range(len(sent_entities) - 1):
         for j in range(i + 1, len(sent_entities)):
             pair = (sent_entities[i], sent_entities[j])
@@ -48,19 +100,107 @@ def pattern_extract(sent_entities: List[tuple], sentence: str, sent_parsed: Sent
                 # if not same entities
                 if key[0].lower() != key[1].lower():
                     patterns = extract_features(pair, sent_parsed, printing)
+                    results.append((key, pair[0][2], pair[1][2], patterns))
+
+    return results
+
+
+def update_trackers(results: List[Tuple[Tuple[str, str], str, str, List[Set[str]]]],
+                    entity_tracker: EntityTracker, pattern_tracker: PatternTracker) -> None:
+
+    for key, type1, type2, patterns in results:
+
+        # dict of form { entity_pair : [patterns] } --> pairs as keys and list of patterns as values
+        # entity pair of tuple form ('ne1', 'ne2') --> e.g. ( 'Mouse', 'Fragile X Syndrome')
+        entity_tracker.update(key, type1, type2)
+        pattern_tracker.update(key, patterns)
+
+
+def pattern_extract(sent_entities: List[tuple], sentence: str, sent_parsed: Sentence,
+                    entity_tracker: EntityTracker, pattern_tracker: PatternTracker, printing: bool) -> None:
+
+    update_trackers(pair_patterns(sent_entities, sentence, sent_parsed, printing), entity_tracker, pattern_tracker)
+
+
+def print_sample_header(sentence: str) -> None:
+
+    print('=' * 50)
+    print('\nOne sample of feature generation process')
+    print('The sentence:', sentence)
+
+
+def find_duplicates(data: List[str], args) -> Tuple[List[int], Counter]:
+
+    # canonical line idx of each line, and number of skipped copies of each canonical line
+    if args.dedup == 'none':
+        return list(range(len(data))), Counter()
+
+    from dedup import deduplicate
+    canonical = deduplicate(data, args.dedup, args.near_threshold)
+    num_copies = Counter(canon for idx, canon in enumerate(canonical) if idx != canon)
+
+    return canonical, num_copies
+
+
+def credit_duplicates(line_pairs: dict, num_copies: Counter, entity_tracker: EntityTracker) -> None:
+
+    # each skipped copy counts as one more occurrence of the pairs found in its canonical line
+    for idx, count in num_copies.items():
+        entity_tracker.add_occurrences(line_pairs.get(idx, []), count)
+
+
+def get_spiller(args):
+
+    # trackers only go to disk when a memory budget is given
+    if args.tracker_budget is None:
+        return None
+
+    from spill import TrackerSpiller
+    return TrackerSpiller(args.tracker_budget, args.path_to_data_dir)
+
 
-                    # dict of form { entity_pair : [patterns] } --> pairs as keys and list of patterns as values
-                    # entity pair of tuple form ('ne1', 'ne2') --> e.g. ( 'Mouse', 'Fragile X Syndrome')
-                    entity_tracker.update(key, pair[0][2], pair[1][2])
-                    pattern_tracker.update(key, patterns)
+def get_profiler(args):
 
+    # stages are only timed and profiled with --profile
+    if args.profile is None:
+        return None
 
-def extraction(data: List[str], args) -> Tuple[EntityTracker, PatternTracker]:
+    from profiling import ExtractionProfiler, PROFILE_STAGES
+    return ExtractionProfiler(args.profile or PROFILE_STAGES, args.slow_sentences)
+
+
+def profile_stage(profiler, stage: str):
+    return profiler.measure(stage) if profiler is not None else nullcontext()
+
+
+def finish_trackers(entity_tracker: EntityTracker, pattern_tracker: PatternTracker,
+                    spiller) -> Tuple[EntityTracker, PatternTracker, sparse.csr_matrix]:
+
+    # with a spiller, trackers and pair-pattern matrix come from merging the runs on disk
+    if spiller is not None:
+        return spiller.merge(entity_tracker, pattern_tracker)
+
+    return entity_tracker, pattern_tracker, pair_pattern_matrix(pattern_tracker, entity_tracker)
+
+
+def extraction(data: List[str], args,
+               models: tuple = None) -> Tuple[EntityTracker, PatternTracker, sparse.csr_matrix]:
 
     entity_tracker = EntityTracker()
     pattern_tracker = PatternTracker()
+    spiller = get_spiller(args)
+    profiler = get_profiler(args)
+
+    # the models only run on one copy of duplicate lines
+    canonical, num_copies = find_duplicates(data, args)
+    line_pairs = dict()  # { canonical line idx : [pairs] }, only for lines having duplicates
 
-    analyzer, ner_tagger = load_models()
+    # models can be given as (analyzer, ner tagger, flair Sentence class), e.g. the stand-ins of the benchmark
+    if models is None:
+        analyzer, ner_tagger = load_models(args)
+        sentence_class = None
+    else:
+        analyzer, ner_tagger, sentence_class = models
 
     # loop through each sentence and perform NER tagging
     # extract triple
@@ -71,29 +211,49 @@ def extraction(data: List[str], args) -> Tuple[EntityTracker, PatternTracker]:
         if num_line == 300 or num_line == 500 or num_line == 700 or num_line == 900:
             print('at line', num_line)
 
+        if canonical[num_line - 1] != num_line - 1:
+            continue
+
         # perform analysis, including tokenized, parsing
-        sent_parsed = analyzer(line)
+        if profiler is not None:
+            profiler.start_line()
+        with profile_stage(profiler, 'stanza'):
+            sent_parsed = analyzer(line)
 
         # get tokenized sentence
         for sent_idx in range(len(sent_parsed.sentences)):
 
             sentence = ' '.join([token.text for token in sent_parsed.sentences[sent_idx].tokens])
-            sent_entities = ner_extract(sentence, ner_tagger)
+            with profile_stage(profiler, 'flair'):
+                sent_entities = ner_extract(sentence, ner_tagger, sentence_class)
 
             printing = False
             if num_line == mark_print:
                 printing = True
-
-                print('=' * 50)
-                print('\nOne sample of feature generation process')
-                print('The sentence:', sentence)
+                print_sample_header(sentence)
 
             # extract patterns / patterns from the sentence if that sentence contains more than 2 entities
+            results = list()
             if len(sent_entities) >= 2:
-                pattern_extract(sent_entities, sentence, sent_parsed.sentences[sent_idx],
-                                entity_tracker, pattern_tracker, printing)
+                with profile_stage(profiler, 'features'):
+                    results = pair_patterns(sent_entities, sentence, sent_parsed.sentences[sent_idx], printing)
+                with profile_stage(profiler, 'trackers'):
+                    update_trackers(results, entity_tracker, pattern_tracker)
+
+                if num_line - 1 in num_copies:
+                    line_pairs.setdefault(num_line - 1, []).extend([result[0] for result in results])
+                if spiller is not None:
+                    spiller.add(results, entity_tracker, pattern_tracker)
+
+            if profiler is not None:
+                profiler.end_sentence(num_line, sentence, sent_entities, sent_parsed.sentences[sent_idx], results,
+                                      len(sent_parsed.sentences))
+
+    credit_duplicates(line_pairs, num_copies, entity_tracker)
+    if profiler is not None:
+        profiler.report(os.path.join(args.path_to_data_dir, 'profile'))
 
-    return entity_tracker, pattern_tracker
+    return finish_trackers(entity_tracker, pattern_tracker, spiller)
 
 
 def print_entity_info(entity_tracker: EntityTracker) -> None:
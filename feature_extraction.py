@@ -1,7 +1,10 @@
-from typing import Set, List, Tuple
+from __future__ import annotations
+from typing import Set, List, Tuple, TYPE_CHECKING
 from itertools import chain, combinations
-import networkx as nx
-from stanza.models.common.doc import Sentence, Word
+
+# stanza is only needed for type hints here, so unpickling trackers does not load it
+if TYPE_CHECKING:
+    from stanza.models.common.doc import Sentence, Word
 
 
 class PatternTracker:
@@ -12,6 +15,13 @@ class PatternTracker:
         self.pairs2patterns = dict()
         self.patterns = list()
 
+    def clear(self, keep_patterns: bool = False):
+
+        # forget the pairs tracked so far, and the patterns too unless they are kept as vocabulary
+        self.pairs2patterns.clear()
+        if not keep_patterns:
+            self.patterns.clear()
+
     def update(self, key: Tuple[str, str], patterns: List[Set[str]]):
         self.add_pair2pattern(key, patterns)
         self.add_pattern(patterns)
@@ -113,6 +123,8 @@ def remove_tag_tail(tokens: Set[str]) -> Set[str]:
 
 def get_feature_tokens(pair: tuple, dep_path: Sentence) -> Tuple[Set[str], Set[str]]:
 
+    import networkx as nx
+
     # words in the dep path
     words = dep_path.words
 
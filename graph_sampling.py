@@ -0,0 +1,251 @@
+import os
+import time
+import sqlite3
+from random import randrange, sample
+from typing import List, Tuple, Optional, Iterator
+from collections import Counter
+
+from entity_extraction import EntityTracker
+
+
+SCHEMA = """
+CREATE TABLE pairs (rank INTEGER PRIMARY KEY, head TEXT NOT NULL, tail TEXT NOT NULL, short INTEGER NOT NULL,
+                    cluster INTEGER);
+CREATE TABLE covid_pairs (idx INTEGER PRIMARY KEY, rank INTEGER NOT NULL);
+CREATE TABLE adjacency (entity TEXT NOT NULL, position INTEGER NOT NULL, rank INTEGER NOT NULL);
+CREATE TABLE clusters (idx INTEGER PRIMARY KEY, cluster INTEGER NOT NULL, size INTEGER NOT NULL);
+CREATE TABLE cluster_pairs (cluster INTEGER NOT NULL, position INTEGER NOT NULL, rank INTEGER NOT NULL);
+"""
+
+# created after the bulk insert, as in the knowledge graph store
+INDEXES = """
+CREATE INDEX pairs_short ON pairs (short, rank);
+CREATE UNIQUE INDEX adjacency_entity ON adjacency (entity, position);
+CREATE UNIQUE INDEX cluster_pairs_cluster ON cluster_pairs (cluster, position);
+"""
+
+
+def build_graph_index(entity_tracker: EntityTracker, clusters: Optional[dict], path_to_db: str) -> None:
+    """
+    Write the occurrence, degree and cluster orders of the pairs to an SQLite database, replacing any existing one.
+    Pairs are ranked by occurrences, and every list keeps the rank of its pairs in the order it is read in,
+    so that drawing a graph only reads the first rows of a list through the indexes
+
+    :param entity_tracker: entity tracker from extraction
+    :param clusters: dict with cluster labels of the pairs in the pair-pattern matrix, or None
+    :param path_to_db: path of the database file
+    """
+
+    start = time.perf_counter()
+    if os.path.isfile(path_to_db):
+        os.remove(path_to_db)
+
+    connection = sqlite3.connect(path_to_db)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.executescript(SCHEMA)
+
+    # pairs with most occurrences first
+    occurrences = entity_tracker.occurrence_counter
+    pairs_by_occurrence = sorted(entity_tracker.entity_pairs, key=lambda pair: (-occurrences[pair], pair))
+    pair2rank = {pair: rank for rank, pair in enumerate(pairs_by_occurrence)}
+
+    pair2cluster = dict()
+    if clusters is not None:
+        for pair, idx in entity_tracker.pair2idx.items():
+            pair2cluster[pair] = int(clusters['labels'][idx])
+
+    connection.executemany('INSERT INTO pairs VALUES (?, ?, ?, ?, ?)',
+                           ((rank, pair[0], pair[1], int(short_pair(pair)), pair2cluster.get(pair))
+                            for rank, pair in enumerate(pairs_by_occurrence)))
+
+    # covid pairs are numbered from 0, so that a random one is looked up by its number
+    covid_ranks = sorted(pair2rank[pair] for pair in entity_tracker.covid_pairs if pair in pair2rank)
+    connection.executemany('INSERT INTO covid_pairs VALUES (?, ?)', enumerate(covid_ranks))
+
+    # number of distinct entities each entity is paired with
+    degree = Counter()
+    for head, tail in entity_tracker.entity_pairs:
+        degree[head] += 1
+        degree[tail] += 1
+
+    # neighbours of each entity, highest degree first
+    adjacency = dict()
+    for head, tail in pairs_by_occurrence:
+        adjacency.setdefault(head, []).append((head, tail))
+        adjacency.setdefault(tail, []).append((head, tail))
+
+    def adjacency_rows():
+        for entity, pairs in adjacency.items():
+            pairs = sorted(pairs, key=lambda pair: -degree[other_entity(pair, entity)])
+            for position, pair in enumerate(pairs):
+                yield entity, position, pair2rank[pair]
+
+    connection.executemany('INSERT INTO adjacency VALUES (?, ?, ?)', adjacency_rows())
+
+    # pairs of each cluster, most occurrences first, and clusters with most pairs first
+    cluster2pairs = dict()
+    for pair in pairs_by_occurrence:
+        if pair in pair2cluster:
+            cluster2pairs.setdefault(pair2cluster[pair], []).append(pair)
+    clusters_by_size = sorted(cluster2pairs, key=lambda cid: -len(cluster2pairs[cid]))
+
+    connection.executemany('INSERT INTO clusters VALUES (?, ?, ?)',
+                           ((idx, cid, len(cluster2pairs[cid])) for idx, cid in enumerate(clusters_by_size)))
+    connection.executemany('INSERT INTO cluster_pairs VALUES (?, ?, ?)',
+                           ((cid, position, pair2rank[pair]) for cid, pairs in cluster2pairs.items()
+                            for position, pair in enumerate(pairs)))
+
+    connection.executescript(INDEXES)
+    connection.commit()
+    connection.close()
+
+    print('=' * 50)
+    print('Graph index written to {} in {:.2f}s'.format(path_to_db, time.perf_counter() - start))
+    print('Pairs, covid pairs, entities, clusters:', len(pairs_by_occurrence), len(covid_ranks), len(adjacency),
+          len(clusters_by_size))
+    print('=' * 50)
+
+
+class GraphIndex:
+    """
+    Read-only queries on the graph index, each one only reads the rows of the pairs it returns
+    Each edge is (head, tail, cluster), the cluster is None for pairs without a cluster
+    """
+
+    def __init__(self, path_to_db: str):
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path_to_db), uri=True)
+
+    def close(self):
+        self.connection.close()
+
+    def top_edges(self, limit: int) -> List[Tuple[str, str, Optional[int]]]:
+
+        # long entity names make the drawing unreadable, only short pairs are drawn
+        return self.connection.execute(
+            'SELECT head, tail, cluster FROM pairs WHERE short = 1 ORDER BY rank LIMIT ?', (limit,)).fetchall()
+
+    def ego_edges(self, entity: str, limit: int) -> List[Tuple[str, str, Optional[int]]]:
+
+        # the entity and its neighbours with the highest degree
+        return self.connection.execute(
+            """SELECT p.head, p.tail, p.cluster
+               FROM adjacency a JOIN pairs p ON p.rank = a.rank
+               WHERE a.entity = ?
+               ORDER BY a.position LIMIT ?""", (entity.lower(), limit)).fetchall()
+
+    def cluster_edges(self, cid: int, limit: int) -> List[Tuple[str, str, Optional[int]]]:
+        return self.connection.execute(
+            """SELECT p.head, p.tail, p.cluster
+               FROM cluster_pairs c JOIN pairs p ON p.rank = c.rank
+               WHERE c.cluster = ?
+               ORDER BY c.position LIMIT ?""", (cid, limit)).fetchall()
+
+    def clusters_by_size(self) -> Iterator[int]:
+
+        # the cursor reads the clusters one at a time, so a caller that stops early does not read them all
+        return (row[0] for row in self.connection.execute('SELECT cluster FROM clusters ORDER BY idx'))
+
+    def num_covid_pairs(self) -> int:
+
+        # covid pairs are numbered from 0 without gaps, the largest number is read from the primary key
+        last = self.connection.execute('SELECT MAX(idx) FROM covid_pairs').fetchone()[0]
+        return last + 1 if last is not None else 0
+
+    def covid_edge(self, idx: int) -> Tuple[str, str, int, Optional[int]]:
+
+        # (head, tail, short, cluster) of the covid pair with the given number
+        return self.connection.execute(
+            """SELECT p.head, p.tail, p.short, p.cluster
+               FROM covid_pairs c JOIN pairs p ON p.rank = c.rank
+               WHERE c.idx = ?""", (idx,)).fetchone()
+
+
+def other_entity(pair: Tuple[str, str], entity: str) -> str:
+    return pair[1] if pair[0] == entity else pair[0]
+
+
+def short_pair(pair: Tuple[str, str]) -> bool:
+
+    # long entity names make the drawing unreadable
+    return len(pair[0].split()) <= 2 and len(pair[1].split()) <= 2
+
+
+def random_draws(num_items: int, num_draws: int) -> List[int]:
+
+    # at most num_draws random indexes, so large graphs are not shuffled as a whole
+    # and small graphs with few usable pairs do not loop forever
+    if num_items <= num_draws:
+        return sample(range(num_items), num_items)
+
+    return [randrange(num_items) for _ in range(num_draws)]
+
+
+def random_edges(index: GraphIndex, num_nodes: int) -> List[Tuple[str, str, Optional[int]]]:
+
+    # at most num_nodes * 20 random covid pairs are read, each one by its number
+    edges = list()
+    seen = set()
+    for idx in random_draws(index.num_covid_pairs(), num_nodes * 20):
+        head, tail, short, cid = index.covid_edge(idx)
+        if short and (head, tail) not in seen:
+            seen.add((head, tail))
+            edges.append((head, tail, cid))
+        if len(edges) >= num_nodes:
+            break
+
+    return edges
+
+
+def cluster_sample(index: GraphIndex, num_nodes: int, per_cluster: int) -> List[Tuple[str, str, Optional[int]]]:
+
+    # most frequent pairs of the largest clusters, until there are enough pairs
+    edges = list()
+    for cid in index.clusters_by_size():
+        edges.extend(index.cluster_edges(cid, per_cluster))
+        if len(edges) >= num_nodes:
+            break
+
+    return edges[:num_nodes]
+
+
+def sample_edges(index: GraphIndex, args) -> List[Tuple[str, str, str]]:
+    """
+    Pick the pairs to draw, according to args.sample
+
+    :param index: graph index of our data
+    :param args: arguments, with sample, num_nodes, entity and per_cluster
+    :return: list of edges (head, tail, label), labelled with the cluster id when there are clusters
+    """
+
+    if args.sample == 'top':
+        edges = index.top_edges(args.num_nodes)
+    elif args.sample == 'ego':
+        edges = index.ego_edges(args.entity, args.num_nodes)
+    elif args.sample == 'cluster':
+        edges = cluster_sample(index, args.num_nodes, args.per_cluster)
+    else:
+        edges = random_edges(index, args.num_nodes)
+
+    return [(head, tail, str(cid) if cid is not None else '') for head, tail, cid in edges]
+
+
+def render_graph(graph, path_to_file: str, output_format: str) -> str:
+
+    # write the graph to a file without opening a viewer, so it also works on servers without display
+    # dot only needs the graph source, other formats need the Graphviz binaries
+    if output_format == 'dot':
+        return graph.save(path_to_file + '.dot')
+
+    graph.format = output_format
+    return graph.render(path_to_file, cleanup=True, view=False)
+
+
+def index_is_fresh(path_to_index: str, paths_to_data: List[str]) -> bool:
+
+    # the index is reused as long as it is newer than the trackers and clusters it was built from
+    if not os.path.isfile(path_to_index):
+        return False
+
+    return all(os.path.getmtime(path_to_index) >= os.path.getmtime(path) for path in paths_to_data
+               if os.path.isfile(path))
@@ -0,0 +1,173 @@
+import os
+import time
+import sqlite3
+from typing import List, Tuple, Optional
+from collections import Counter
+
+from entity_extraction import EntityTracker
+from feature_extraction import PatternTracker
+
+
+SCHEMA = """
+CREATE TABLE entities (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, type TEXT NOT NULL);
+CREATE TABLE patterns (id INTEGER PRIMARY KEY, text TEXT NOT NULL);
+CREATE TABLE pairs (id INTEGER PRIMARY KEY, head_id INTEGER NOT NULL, tail_id INTEGER NOT NULL,
+                    occurrences INTEGER NOT NULL, cluster INTEGER, covid INTEGER NOT NULL);
+CREATE TABLE pair_patterns (pair_id INTEGER NOT NULL, pattern_id INTEGER NOT NULL, count INTEGER NOT NULL);
+"""
+
+# created after the bulk insert, which is faster than keeping them up to date row by row
+INDEXES = """
+CREATE INDEX entities_type ON entities (type);
+CREATE UNIQUE INDEX pairs_head_tail ON pairs (head_id, tail_id);
+CREATE INDEX pairs_tail ON pairs (tail_id);
+CREATE INDEX pairs_cluster ON pairs (cluster);
+CREATE INDEX pair_patterns_pair ON pair_patterns (pair_id, count);
+CREATE INDEX pair_patterns_pattern ON pair_patterns (pattern_id);
+"""
+
+
+def pattern_text(pattern: set) -> str:
+    return ' '.join(sorted(pattern))
+
+
+def build_store(entity_tracker: EntityTracker, pattern_tracker: PatternTracker, clusters: Optional[dict],
+                path_to_db: str) -> None:
+    """
+    Write entities, pairs, patterns and cluster labels to an SQLite database, replacing any existing one
+
+    :param entity_tracker: entity tracker from extraction
+    :param pattern_tracker: pattern tracker from extraction
+    :param clusters: dict with cluster labels of the pairs in the pair-pattern matrix, or None
+    :param path_to_db: path of the database file
+    """
+
+    start = time.perf_counter()
+    if os.path.isfile(path_to_db):
+        os.remove(path_to_db)
+
+    connection = sqlite3.connect(path_to_db)
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.executescript(SCHEMA)
+
+    # an entity can be tagged with several types, keep the most frequent one
+    entity2id = {entity: idx for idx, entity in enumerate(entity_tracker.entity2type)}
+    connection.executemany('INSERT INTO entities VALUES (?, ?, ?)',
+                           ((idx, entity, Counter(entity_tracker.entity2type[entity]).most_common(1)[0][0])
+                            for entity, idx in entity2id.items()))
+
+    pattern2id = {frozenset(pattern): idx for idx, pattern in enumerate(pattern_tracker.patterns)}
+    connection.executemany('INSERT INTO patterns VALUES (?, ?)',
+                           ((idx, pattern_text(pattern)) for idx, pattern in enumerate(pattern_tracker.patterns)))
+
+    # pairs in the pair-pattern matrix keep their row idx as id, so that it matches the cluster labels
+    labels = clusters['labels'] if clusters is not None else None
+    pair2id = dict(entity_tracker.pair2idx)
+    for pair in entity_tracker.entity_pairs:
+        if pair not in pair2id:
+            pair2id[pair] = len(pair2id)
+
+    def pair_rows():
+        for pair, idx in pair2id.items():
+            cluster = int(labels[idx]) if labels is not None and pair in entity_tracker.pair2idx else None
+            yield (idx, entity2id[pair[0]], entity2id[pair[1]], entity_tracker.occurrence_counter[pair], cluster,
+                   int(pair in entity_tracker.covid_pairs))
+
+    connection.executemany('INSERT INTO pairs VALUES (?, ?, ?, ?, ?, ?)', pair_rows())
+
+    def pair_pattern_rows():
+        for pair, patterns in pattern_tracker.pairs2patterns.items():
+            counts = Counter(pattern2id[frozenset(pattern)] for pattern in patterns)
+            for pattern_id, count in counts.items():
+                yield pair2id[pair], pattern_id, count
+
+    connection.executemany('INSERT INTO pair_patterns VALUES (?, ?, ?)', pair_pattern_rows())
+
+    connection.executescript(INDEXES)
+    connection.commit()
+    connection.close()
+
+    print('=' * 50)
+    print('Knowledge graph store written to {} in {:.2f}s'.format(path_to_db, time.perf_counter() - start))
+    print('Entities, pairs, patterns:', len(entity2id), len(pair2id), len(pattern2id))
+    print('=' * 50)
+
+
+class KGStore:
+    """
+    Read-only queries on the SQLite store, each one only reads the rows it needs through the indexes
+    """
+
+    def __init__(self, path_to_db: str):
+        self.connection = sqlite3.connect('file:{}?mode=ro'.format(path_to_db), uri=True)
+
+    def close(self):
+        self.connection.close()
+
+    def neighbours(self, entity: str, limit: int = 20) -> List[Tuple[str, str, str, int, Optional[int]]]:
+
+        # entities paired with the given one, in either position
+        # each row: (neighbour, its type, 'out' if the entity is the head else 'in', occurrences, cluster)
+        return self.connection.execute(
+            """SELECT n.name, n.type, 'out', p.occurrences, p.cluster
+               FROM entities e JOIN pairs p ON p.head_id = e.id JOIN entities n ON n.id = p.tail_id
+               WHERE e.name = ?
+               UNION ALL
+               SELECT n.name, n.type, 'in', p.occurrences, p.cluster
+               FROM entities e JOIN pairs p ON p.tail_id = e.id JOIN entities n ON n.id = p.head_id
+               WHERE e.name = ?
+               ORDER BY 4 DESC LIMIT ?""", (entity.lower(), entity.lower(), limit)).fetchall()
+
+    def pairs_by_type(self, head_type: str, tail_type: str, cluster: Optional[int] = None,
+                      limit: int = 20) -> List[Tuple[str, str, int, Optional[int]]]:
+
+        # pairs whose entities have the given types, in either order, optionally only in one cluster
+        # each row: (head, tail, occurrences, cluster)
+        query = """SELECT h.name, t.name, p.occurrences, p.cluster
+                   FROM pairs p JOIN entities h ON h.id = p.head_id JOIN entities t ON t.id = p.tail_id
+                   WHERE ((h.type = ? AND t.type = ?) OR (h.type = ? AND t.type = ?))"""
+        parameters = [head_type.upper(), tail_type.upper(), tail_type.upper(), head_type.upper()]
+
+        if cluster is not None:
+            query += ' AND p.cluster = ?'
+            parameters.append(cluster)
+
+        query += ' ORDER BY p.occurrences DESC LIMIT ?'
+        parameters.append(limit)
+
+        return self.connection.execute(query, parameters).fetchall()
+
+    def top_patterns(self, head: str, tail: str, limit: int = 10) -> List[Tuple[str, int]]:
+
+        # each row: (pattern, count of the pattern for the pair)
+        return self.connection.execute(
+            """SELECT pt.text, pp.count
+               FROM entities h JOIN entities t JOIN pairs p ON p.head_id = h.id AND p.tail_id = t.id
+               JOIN pair_patterns pp ON pp.pair_id = p.id JOIN patterns pt ON pt.id = pp.pattern_id
+               WHERE h.name = ? AND t.name = ?
+               ORDER BY pp.count DESC LIMIT ?""", (head.lower(), tail.lower(), limit)).fetchall()
+
+
+def run_query(path_to_db: str, args) -> list:
+
+    store = KGStore(path_to_db)
+    start = time.perf_counter()
+
+    if args.query == 'neighbours':
+        rows = store.neighbours(args.entity, args.limit)
+    elif args.query == 'pairs':
+        rows = store.pairs_by_type(args.entity_types[0], args.entity_types[1], args.cluster, args.limit)
+    else:
+        rows = store.top_patterns(args.entity, args.other_entity, args.limit)
+
+    query_time = (time.perf_counter() - start) * 1000
+    store.close()
+
+    print('=' * 50)
+    for row in rows:
+        print(row)
+    print('{} rows in {:.2f} ms'.format(len(rows), query_time))
+    print('=' * 50)
+
+    return rows
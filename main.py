@@ -1,12 +1,11 @@
+import os
 import sys
 import argparse
-from random import randrange, shuffle
-import graphviz
 
-from read_datasets import *
-from extraction import *
-from clustering import *
-from evaluation import *
+from read_datasets import read_data, load_compressed_data, write_compressed_data
+from timing import startup_timer
+
+# modules of each stage are imported only when the stage runs, so that e.g. clustering does not load torch
 
 
 def run_read_corpus():
@@ -15,23 +14,45 @@ def run_read_corpus():
 
 def run_extraction():
 
+    with startup_timer.measure('extract', 'import'):
+        from extraction import extraction, print_entity_info, print_pattern_info
+        from pattern_index import PatternIndex, print_pattern_index_info
+        if args.pipeline and args.profile is None:
+            from pipeline import pipelined_extraction
+
+    # stages are profiled one after the other, so profiling runs without the pipeline
+    if args.pipeline and args.profile is not None:
+        print('Profiling runs extraction without --pipeline')
+
     data = load_compressed_data(corpus_path)
-    entity_tracker, pattern_tracker = extraction(data, args)
-    matrix = pair_pattern_matrix(pattern_tracker, entity_tracker)
+    if args.pipeline and args.profile is None:
+        entity_tracker, pattern_tracker, matrix = pipelined_extraction(data, args)
+    else:
+        entity_tracker, pattern_tracker, matrix = extraction(data, args)
 
     print_entity_info(entity_tracker)
     print_pattern_info(pattern_tracker)
 
     write_compressed_data([entity_tracker, pattern_tracker, matrix], 'trackers', args.path_to_data_dir)
 
+    # inverted index from patterns to pairs, saved next to the trackers
+    pattern_index = PatternIndex(matrix, pattern_tracker)
+    print_pattern_index_info(pattern_index)
+    write_compressed_data(pattern_index, 'pattern_index', args.path_to_data_dir)
+
 
 def run_clustering():
 
+    with startup_timer.measure('cluster', 'import'):
+        from clustering import clustering, cluster_pattern_matrix, print_cluster_info
+
     _, _, matrix = load_compressed_data(trackers_path)
     clustering_parameters = {'distance_metric': args.distance_metric,
                              'linkage': args.linkage,
                              'distance_threshold': args.distance_threshold,
-                             'n_clusters': None}
+                             'n_clusters': None,
+                             'path_to_data_dir': args.path_to_data_dir,
+                             'memory_budget': args.memory_budget}
     clusters = clustering(matrix, clustering_parameters)
     cp_matrix = cluster_pattern_matrix(clusters, matrix, args)
 
@@ -44,10 +65,14 @@ def run_clustering():
 
 def run_evaluation():
 
+    with startup_timer.measure('evaluate', 'import'):
+        from evaluation import get_cido_triples, print_cido_info, build_eval_dicts, bcubed_scores
+        from clustering import build_cid2pidx, get_ranked_patterns
+
     clusters, cp_matrix = load_compressed_data(cluster_path)
     entity_tracker, pattern_tracker, _ = load_compressed_data(trackers_path)
 
-    cido = get_cido_triples(entity_tracker)
+    cido = get_cido_triples(entity_tracker, args.normalised_match)
     cid2pidx = build_cid2pidx(clusters)
 
     print_cido_info(cido)
@@ -106,71 +131,279 @@ def run_evaluation():
     print('Number of clusters having more than 2 pairs:', valid_pairs)
 
 
-def run_visualization():
+def run_assignment():
+
+    with startup_timer.measure('assign', 'import'):
+        from assignment import assign_pairs
+
+    clusters, _ = load_compressed_data(cluster_path)
+    _, pattern_tracker, matrix = load_compressed_data(trackers_path)
+    _, new_tracker, _ = load_compressed_data(args.new_trackers)
+
+    assignments = assign_pairs(new_tracker, pattern_tracker, matrix, clusters, args)
+    write_compressed_data(assignments, 'assignments', args.path_to_data_dir)
+
+
+def run_store():
+
+    with startup_timer.measure('store', 'import'):
+        from kg_store import build_store
+
+    entity_tracker, pattern_tracker, _ = load_compressed_data(trackers_path)
+    clusters = load_compressed_data(cluster_path)[0] if os.path.isfile(cluster_path) else None
+
+    build_store(entity_tracker, pattern_tracker, clusters, store_path)
+
+
+def run_export():
+
+    with startup_timer.measure('export', 'import'):
+        from rdf_export import export_rdf
 
     entity_tracker, pattern_tracker, _ = load_compressed_data(trackers_path)
+    clusters, cp_matrix = load_compressed_data(cluster_path) if os.path.isfile(cluster_path) else (None, None)
+
+    # entities matched with cido by evaluate keep their cido uri
+    cido = load_compressed_data(cido_path) if os.path.isfile(cido_path) else None
+    entity2uri = getattr(cido, 'entity2uri', dict())
+    if cido is not None and not entity2uri:
+        print('Warning: cido.zipped has no CIDO uris, run evaluate again to use them in the export')
+
+    export_rdf(entity_tracker, pattern_tracker, clusters, cp_matrix, entity2uri, args)
+
+
+def run_query():
+
+    with startup_timer.measure('query', 'import'):
+        from kg_store import run_query as query
+
+    query(store_path, args)
+
+
+def run_pattern_query():
+
+    with startup_timer.measure('pattern-query', 'import'):
+        from pattern_index import PatternIndex, ranked_pairs, print_pattern_index_info
+
+    entity_tracker, pattern_tracker, matrix = load_compressed_data(trackers_path)
+
+    if os.path.isfile(pattern_index_path):
+        pattern_index = load_compressed_data(pattern_index_path)
+    else:
+        pattern_index = PatternIndex(matrix, pattern_tracker)
+        print_pattern_index_info(pattern_index)
+        write_compressed_data(pattern_index, 'pattern_index', args.path_to_data_dir)
+
+    if args.pattern_ids:
+        print('Pairs having all patterns', [pattern_tracker.patterns[idx] for idx in args.pattern_ids])
+        pair_idxs, counts = pattern_index.intersect(args.pattern_ids)
+    else:
+        print('Pairs having a pattern with all tokens', args.pattern_tokens)
+        pair_idxs, counts = pattern_index.subset(args.pattern_tokens)
+
+    print('Number of pairs:', len(pair_idxs))
+    print(ranked_pairs(pair_idxs, counts, entity_tracker, args.limit))
+
+
+def run_service():
+
+    with startup_timer.measure('serve', 'import'):
+        from service import serve
+
+    serve(args)
+
+
+def run_cpu_check():
+
+    with startup_timer.measure('cpu-check', 'import'):
+        import flair
+        import torch
+        from flair.models import MultiTagger
+        from cpu_inference import check_quantization, set_interop_threads
+
+    # the tagger is loaded on cpu, otherwise on a GPU host both taggers would run on cuda
+    flair.device = torch.device('cpu')
+    set_interop_threads(args.inter_threads)
+    if args.intra_threads:
+        torch.set_num_threads(args.intra_threads)
+
+    with startup_timer.measure('cpu-check', 'load hunflair'):
+        ner_tagger = MultiTagger.load("hunflair")
+
+    data = load_compressed_data(corpus_path)
+    check_quantization(data[:args.check_sent], ner_tagger, args.min_f1)
+
+
+def run_benchmark():
+
+    with startup_timer.measure('benchmark', 'import'):
+        from benchmark import run_benchmark as benchmark
+
+    return benchmark(args)
+
+
+def run_visualization():
+
+    with startup_timer.measure('visual', 'import'):
+        import graphviz
+        from graph_sampling import GraphIndex, build_graph_index, sample_edges, render_graph, index_is_fresh
 
     if args.with_data == 'cido':
         cido = load_compressed_data(cido_path)
         visual_cido(cido)
+        return
 
-    # Draw a graph from our dataset
-    print('Randomly pick pairs from dataset and draw a graph...')
-    graph = graphviz.Digraph(format='png', node_attr={'color': 'lightblue2', 'style': 'filled'})
+    # the graph index is built once, later runs only read the rows of the pairs they draw
+    if not index_is_fresh(graph_index_path, [trackers_path, cluster_path]):
+        entity_tracker, _, _ = load_compressed_data(trackers_path)
+        clusters = load_compressed_data(cluster_path)[0] if os.path.isfile(cluster_path) else None
+        build_graph_index(entity_tracker, clusters, graph_index_path)
 
-    # get entity pairs with suitable type
-    pairs = list(entity_tracker.covid_pairs)
-    shuffle(pairs)
+    # Draw a graph from our dataset
+    print('Pick pairs from dataset ({}) and draw a graph...'.format(args.sample))
+    graph = graphviz.Digraph(node_attr={'color': 'lightblue2', 'style': 'filled'})
 
-    num_nodes = 0
-    for pair in pairs:
-        if len(pair[0].split()) <= 2 and len(pair[1].split()) <= 2:
-            graph.edge(pair[0], pair[1])
-            num_nodes += 1
+    index = GraphIndex(graph_index_path)
+    for head, tail, label in sample_edges(index, args):
+        graph.edge(head, tail, label=label)
+    index.close()
 
-        if num_nodes >= args.num_nodes:
-            break
-    graph.view()
+    path_to_file = render_graph(graph, os.path.join(args.path_to_data_dir, 'graph_' + args.sample), args.output_format)
+    print('Graph written to', path_to_file)
 
 
 def visual_cido(cido):
 
+    import graphviz
+    from graph_sampling import render_graph, random_draws
+
     # Draw a graph from CIDO
-    cido_graph = graphviz.Digraph(format='png', node_attr={'color': 'lightblue2', 'style': 'filled'})
+    cido_graph = graphviz.Digraph(node_attr={'color': 'lightblue2', 'style': 'filled'})
     cido_nodes = set()
 
-    while len(cido_nodes) < args.num_nodes:
-        pair = list(cido.all_pairs)[randrange(len(cido.all_pairs))]
+    # at most num_nodes * 20 random pairs, stop when there are enough nodes
+    pairs = list(cido.all_pairs)
+    for idx in random_draws(len(pairs), args.num_nodes * 20):
+        if len(cido_nodes) >= args.num_nodes:
+            break
+
+        pair = pairs[idx]
         cido_graph.edge(str(pair[0]), str(pair[1]), label=str(cido.pair2relation[pair]))
         cido_nodes.update(pair)
 
     print('Randomly pick pairs from CIDO and draw a graph...')
-    cido_graph.view()
-    sys.exit()
+    path_to_file = render_graph(cido_graph, os.path.join(args.path_to_data_dir, 'graph_cido'), args.output_format)
+    print('Graph written to', path_to_file)
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser('Project for Knowledge Discovery course \nKnowledge Graph Construction')
     parser.add_argument('--perform', type=str, default='extract', const='extract', nargs='?',
-                        choices=['read-corpus', 'extract', 'cluster', 'evaluate', 'visual', 'all'],
-                        help='Six choices: read-corpus, extract, cluster, evaluate, visual, all')
+                        choices=['read-corpus', 'extract', 'cluster', 'evaluate', 'assign', 'store', 'export', 'query',
+                                 'pattern-query', 'visual', 'serve', 'cpu-check', 'benchmark', 'all'],
+                        help='Fourteen choices: read-corpus, extract, cluster, evaluate, assign, store, export, query, '
+                             'pattern-query, visual, serve, cpu-check, benchmark, all')
     parser.add_argument('--path_to_data_dir', type=str, default=os.path.join(os.getcwd(), 'data'))
     parser.add_argument('--corpus_name', type=str, default='covid19.vert')
     parser.add_argument('--max_sent', type=int, default=1000)
     parser.add_argument('--mark_print', type=int, default=None,
                         help='Print out features for the chosen sentence')
+    parser.add_argument('--profile', type=str, nargs='*', default=None,
+                        choices=['stanza', 'flair', 'features', 'trackers'],
+                        help='Time extraction per sentence and profile the given stages, all of them if none given')
+    parser.add_argument('--slow_sentences', type=int, default=20,
+                        help='Number of slowest sentences in the profile report')
+    parser.add_argument('--dedup', type=str, default='none', const='exact', nargs='?',
+                        choices=['none', 'exact', 'near'],
+                        help='Skip duplicate lines before running the models, exact ones or also near ones')
+    parser.add_argument('--near_threshold', type=float, default=0.9,
+                        help='Lowest estimated Jaccard similarity of token shingles for a near duplicate')
+    parser.add_argument('--tracker_budget', type=int, default=None,
+                        help='Memory in MB for the trackers during extraction, above which they are spilled to disk')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run parsing, NER tagging and feature extraction at the same time')
+    parser.add_argument('--queue_size', type=int, default=64,
+                        help='Maximum number of lines waiting between two pipeline stages')
+    parser.add_argument('--feature_workers', type=int, default=2,
+                        help='Number of processes extracting features in the pipeline')
+    parser.add_argument('--cpu_inference', action='store_true',
+                        help='Run the models on CPU without autograd, with the given thread counts')
+    parser.add_argument('--intra_threads', type=int, default=None,
+                        help='Threads used inside one torch operation, per worker')
+    parser.add_argument('--inter_threads', type=int, default=None,
+                        help='Threads used to run independent torch operations in parallel')
+    parser.add_argument('--quantize', action='store_true',
+                        help='Apply dynamic int8 quantisation to the HunFlair taggers, with --cpu_inference')
+    parser.add_argument('--check_sent', type=int, default=200,
+                        help='Number of sentences to compare quantised and original HunFlair on')
+    parser.add_argument('--min_f1', type=float, default=0.99,
+                        help='Lowest entity span F1 against the original HunFlair to accept quantisation')
     parser.add_argument('--distance_metric', type=str, default='cosine', const='cosine', nargs='?',
                         choices=['cosine', 'euclidean', 'manhattan'])
     parser.add_argument('--linkage', type=str, default='average', const='average', nargs='?',
                         choices=['average', 'single', 'complete', 'ward'])
     parser.add_argument('--distance_threshold', type=float, default=0.999)
+    parser.add_argument('--memory_budget', type=int, default=512,
+                        help='Memory in MB for the blocks of the distance matrix computed at once')
+    parser.add_argument('--new_trackers', type=str, default=None,
+                        help='Trackers file of newly extracted pairs to assign to the existing clusters')
     parser.add_argument('--ranked_metric', type=str, default='count', const='count', nargs='?',
                         choices=['count', 'tfidf'])
+    parser.add_argument('--normalised_match', action='store_true',
+                        help='Also match CIDO labels to our entities by case, hyphen and spacing variants')
+    parser.add_argument('--query', type=str, default='neighbours', const='neighbours', nargs='?',
+                        choices=['neighbours', 'pairs', 'patterns'],
+                        help='Neighbours of --entity, pairs of --entity_types, or top patterns of a pair')
+    parser.add_argument('--entity', type=str, default=None)
+    parser.add_argument('--other_entity', type=str, default=None,
+                        help='Second entity of the pair, for top patterns of a pair')
+    parser.add_argument('--entity_types', type=str, nargs=2, default=None,
+                        help='Types of the two entities of pairs, e.g. COVID Chemical')
+    parser.add_argument('--cluster', type=int, default=None,
+                        help='Only pairs of this cluster')
+    parser.add_argument('--pattern_ids', type=int, nargs='+', default=None,
+                        help='Pattern ids, as printed with the top patterns of a cluster, to find pairs having all')
+    parser.add_argument('--pattern_tokens', type=str, nargs='+', default=None,
+                        help='Tokens, to find pairs having a pattern that contains all of them')
+    parser.add_argument('--limit', type=int, default=20,
+                        help='Maximum number of rows a query returns')
+    parser.add_argument('--rdf_format', type=str, default='nt', const='nt', nargs='?',
+                        choices=['nt', 'ttl'],
+                        help='N-Triples or Turtle for the exported knowledge graph')
+    parser.add_argument('--chunk_triples', type=int, default=1000000,
+                        help='Maximum number of triples in one exported file')
+    parser.add_argument('--num_patterns', type=int, default=3,
+                        help='Number of top patterns in the label of an exported cluster relation')
     parser.add_argument('--with_data', type=str, default='ours', const='ours', nargs='?',
                         choices=['ours', 'cido'])
     parser.add_argument('--num_nodes', type=int, default=30,
                         help='Number of nodes to draw a graph')
+    parser.add_argument('--sample', type=str, default='random', const='random', nargs='?',
+                        choices=['random', 'top', 'ego', 'cluster'],
+                        help='Random covid pairs, most frequent pairs, neighbours of --entity, or pairs per cluster')
+    parser.add_argument('--per_cluster', type=int, default=5,
+                        help='Number of pairs drawn from each cluster')
+    parser.add_argument('--output_format', type=str, default='png', const='png', nargs='?',
+                        choices=['png', 'svg', 'dot'],
+                        help='Format of the graph file, dot does not need the Graphviz binaries')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address the extraction service listens on')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max_batch', type=int, default=32,
+                        help='Maximum number of texts the service runs through the models at once')
+    parser.add_argument('--batch_window', type=float, default=20,
+                        help='Milliseconds the service waits for more texts before running a batch')
+    parser.add_argument('--bench_scales', type=int, nargs='+', default=[200, 1000],
+                        help='Numbers of synthetic sentences to benchmark the stages on')
+    parser.add_argument('--bench_repeat', type=int, default=3,
+                        help='Runs of each stage, the fastest one is reported')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Benchmark results to compare with, default is benchmark_baseline.json in the data folder')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Save the benchmark results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative increase of time or peak memory over the baseline counted as a regression')
     args = parser.parse_args()
 
     if args.perform == 'read-corpus':
@@ -200,16 +433,95 @@ if __name__ == '__main__':
             print('Please get clusters and trackers files first!!!')
             sys.exit()
 
-    elif args.perform == 'visual':
+    elif args.perform == 'assign':
+        cluster_path = os.path.join(args.path_to_data_dir, 'clusters.zipped')
+        trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
+
+        if os.path.isfile(cluster_path) and args.new_trackers and os.path.isfile(args.new_trackers):
+            run_assignment()
+        else:
+            print('Please get clusters and trackers files first, and give --new_trackers!!!')
+            sys.exit()
+
+    elif args.perform == 'store':
         trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
+        cluster_path = os.path.join(args.path_to_data_dir, 'clusters.zipped')
+        store_path = os.path.join(args.path_to_data_dir, 'kg.sqlite')
+
+        if os.path.isfile(trackers_path):
+            run_store()
+        else:
+            print('Please get trackers file first!!!')
+            sys.exit()
+
+    elif args.perform == 'export':
+        trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
+        cluster_path = os.path.join(args.path_to_data_dir, 'clusters.zipped')
         cido_path = os.path.join(args.path_to_data_dir, 'cido.zipped')
 
         if os.path.isfile(trackers_path):
+            run_export()
+        else:
+            print('Please get trackers file first!!!')
+            sys.exit()
+
+    elif args.perform == 'query':
+        store_path = os.path.join(args.path_to_data_dir, 'kg.sqlite')
+
+        if not os.path.isfile(store_path):
+            print('Please run store first to build the knowledge graph store!!!')
+            sys.exit()
+        elif args.query == 'pairs' and args.entity_types is None:
+            print('Please give --entity_types for the pairs query')
+        elif args.query != 'pairs' and args.entity is None:
+            print('Please give --entity for the {} query'.format(args.query))
+        elif args.query == 'patterns' and args.other_entity is None:
+            print('Please give --other_entity for the patterns query')
+        else:
+            run_query()
+
+    elif args.perform == 'pattern-query':
+        trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
+        pattern_index_path = os.path.join(args.path_to_data_dir, 'pattern_index.zipped')
+
+        if not os.path.isfile(trackers_path):
+            print('Please get trackers file first!!!')
+            sys.exit()
+        elif not args.pattern_ids and not args.pattern_tokens:
+            print('Please give --pattern_ids or --pattern_tokens')
+        else:
+            run_pattern_query()
+
+    elif args.perform == 'visual':
+        trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
+        cluster_path = os.path.join(args.path_to_data_dir, 'clusters.zipped')
+        cido_path = os.path.join(args.path_to_data_dir, 'cido.zipped')
+        graph_index_path = os.path.join(args.path_to_data_dir, 'graph_index.sqlite')
+
+        if args.sample == 'ego' and args.entity is None:
+            print('Please give --entity to draw its neighbours')
+        elif os.path.isfile(trackers_path):
             run_visualization()
         else:
             print('Please get clusters and trackers files first!!!')
             sys.exit()
 
+    elif args.perform == 'serve':
+        run_service()
+
+    elif args.perform == 'cpu-check':
+        corpus_path = os.path.join(args.path_to_data_dir, 'corpus.zipped')
+
+        if os.path.isfile(corpus_path):
+            run_cpu_check()
+        else:
+            print('Please run read-corpus first to get the zipped file of data!')
+            sys.exit()
+
+    elif args.perform == 'benchmark':
+        if run_benchmark():
+            sys.exit(1)
+
     elif args.perform == 'all':
         run_read_corpus() if os.path.isfile(os.path.join(args.path_to_data_dir, args.corpus_name)) \
             else print('Please give valid path and/or filename')
@@ -218,6 +530,7 @@ if __name__ == '__main__':
         cluster_path = os.path.join(args.path_to_data_dir, 'clusters.zipped')
         trackers_path = os.path.join(args.path_to_data_dir, 'trackers.zipped')
         cido_path = os.path.join(args.path_to_data_dir, 'cido.zipped')
+        graph_index_path = os.path.join(args.path_to_data_dir, 'graph_index.sqlite')
 
         run_extraction()
         run_clustering()
@@ -225,3 +538,7 @@ if __name__ == '__main__':
         run_visualization()
     else:
         print('Give me some proper command please.....')
+
+    # the service prints the report once its models are loaded, as it then runs until stopped
+    if args.perform != 'serve':
+        startup_timer.report()
@@ -0,0 +1,161 @@
+import numpy as np
+from typing import List, Tuple, Iterable
+from scipy import sparse
+
+from entity_extraction import EntityTracker
+from feature_extraction import PatternTracker
+
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+
+    # LEB128: 7 bits per byte, high bit set on every byte but the last one of a value
+    values = np.asarray(values, dtype=np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        num_bytes += values >= np.uint64(1 << shift)
+
+    positions = np.concatenate(([0], np.cumsum(num_bytes)[:-1])).astype(np.int64)
+    encoded = np.zeros(int(num_bytes.sum()), dtype=np.uint8)
+
+    for group in range(int(num_bytes.max()) if len(values) else 0):
+        mask = num_bytes > group
+        chunk = (values[mask] >> np.uint64(7 * group)) & np.uint64(0x7f)
+        more = (num_bytes[mask] - 1 > group).astype(np.uint64) << np.uint64(7)
+        encoded[positions[mask] + group] = (chunk | more).astype(np.uint8)
+
+    # bytes, and number of bytes of each value
+    return encoded, num_bytes
+
+
+def decode_varints(encoded: np.ndarray) -> np.ndarray:
+
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    # each value ends at a byte without the high bit
+    ends = np.flatnonzero(encoded < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # position of each byte within its value, to shift its 7 bits into place
+    value_idx = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    position = np.arange(len(encoded)) - starts[value_idx]
+    parts = (encoded & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+
+    return np.add.reduceat(parts, starts)
+
+
+class PatternIndex:
+    """
+    Inverted index from pattern id to the pairs having that pattern
+    The posting list of a pattern is its sorted pair idxs (rows of the pair-pattern matrix), delta-encoded,
+    followed by their counts, all as varints in one byte buffer
+    Tokens are also indexed, from token to the ids of the patterns containing it
+    """
+
+    def __init__(self, pp_matrix: sparse.spmatrix, pattern_tracker: PatternTracker):
+
+        matrix = sparse.csc_matrix(pp_matrix)
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+
+        indptr = matrix.indptr.astype(np.int64)
+        lengths = np.diff(indptr)
+        pair_idxs = matrix.indices.astype(np.int64)
+        self.num_postings = len(pair_idxs)
+
+        # gap to the previous pair idx of the same pattern, the first pair idx of a pattern is kept as it is
+        pattern_of_entry = np.repeat(np.arange(matrix.shape[1]), lengths)
+        gaps = np.diff(pair_idxs, prepend=0)
+        first = indptr[:-1][lengths > 0]
+        gaps[first] = pair_idxs[first]
+
+        # all posting lists encoded at once: gaps of a pattern, then its counts, pattern after pattern
+        gap_positions = 2 * indptr[pattern_of_entry] + (np.arange(len(pair_idxs)) - indptr[pattern_of_entry])
+        values = np.zeros(2 * len(pair_idxs), dtype=np.int64)
+        values[gap_positions] = gaps
+        values[gap_positions + lengths[pattern_of_entry]] = matrix.data.astype(np.int64)
+
+        self.postings, num_bytes = encode_varints(values)
+        self.offsets = np.concatenate(([0], np.cumsum(num_bytes)))[2 * indptr]
+
+        # { token : sorted array of pattern ids }
+        token2patterns = dict()
+        for pattern_id, pattern in enumerate(pattern_tracker.patterns):
+            for token in pattern:
+                token2patterns.setdefault(token, []).append(pattern_id)
+        self.token2patterns = {token: np.array(ids, dtype=np.int64) for token, ids in token2patterns.items()}
+
+    def posting(self, pattern_id: int) -> Tuple[np.ndarray, np.ndarray]:
+
+        # pair idxs having the pattern, and count of the pattern for each pair
+        encoded = self.postings[self.offsets[pattern_id]:self.offsets[pattern_id + 1]]
+        values = decode_varints(encoded).astype(np.int64)
+        half = len(values) // 2
+
+        return np.cumsum(values[:half]), values[half:]
+
+    def intersect(self, pattern_ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pairs having every one of the given patterns
+
+        :param pattern_ids: ids of patterns, i.e. their idx in pattern_tracker.patterns
+        :return: pair idxs, and for each of them the summed count of the given patterns
+        """
+
+        postings = sorted([self.posting(pattern_id) for pattern_id in set(pattern_ids)],
+                          key=lambda posting: len(posting[0]))
+        if not postings:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # start from the shortest list so the candidates only shrink
+        pair_idxs, counts = postings[0]
+        for other_idxs, other_counts in postings[1:]:
+            pair_idxs, mask, other_mask = np.intersect1d(pair_idxs, other_idxs, assume_unique=True,
+                                                         return_indices=True)
+            counts = counts[mask] + other_counts[other_mask]
+
+        return pair_idxs, counts
+
+    def patterns_with_tokens(self, tokens: Iterable[str]) -> np.ndarray:
+
+        # ids of the patterns containing all the given tokens
+        pattern_ids = None
+        for token in set(tokens):
+            ids = self.token2patterns.get(token, np.zeros(0, dtype=np.int64))
+            pattern_ids = ids if pattern_ids is None else np.intersect1d(pattern_ids, ids, assume_unique=True)
+
+        return pattern_ids if pattern_ids is not None else np.zeros(0, dtype=np.int64)
+
+    def subset(self, tokens: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pairs having at least one pattern that contains all the given tokens
+
+        :param tokens: pattern tokens, e.g. ['inhibit', 'replication']
+        :return: pair idxs, and for each of them the summed count of the matching patterns
+        """
+
+        postings = [self.posting(pattern_id) for pattern_id in self.patterns_with_tokens(tokens)]
+        if not postings:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        pair_idxs = np.concatenate([idxs for idxs, _ in postings])
+        counts = np.concatenate([counts for _, counts in postings])
+        unique_idxs, inverse = np.unique(pair_idxs, return_inverse=True)
+
+        return unique_idxs, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def ranked_pairs(pair_idxs: np.ndarray, counts: np.ndarray, entity_tracker: EntityTracker,
+                 limit: int) -> List[Tuple[Tuple[str, str], int]]:
+
+    order = np.argsort(-counts, kind='stable')[:limit]
+    return [(entity_tracker.idx2pair[int(pair_idxs[idx])], int(counts[idx])) for idx in order]
+
+
+def print_pattern_index_info(index: PatternIndex) -> None:
+
+    print('=' * 50)
+    print('Pattern index: {} patterns, {} postings, {} tokens, {} bytes of posting lists'.format(
+        len(index.offsets) - 1, index.num_postings, len(index.token2patterns), len(index.postings)))
+    print('=' * 50)
@@ -0,0 +1,228 @@
+from __future__ import annotations
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from extraction import *
+
+
+# marks the end of the input in the queues
+STOP = object()
+
+
+def line_features(num_line: int, doc_dicts: List[list], sentences: List[Tuple[int, str, List[tuple]]],
+                  mark_print: int) -> list:
+
+    # runs in a worker process, the parse of the line is sent as stanza dicts and rebuilt here
+    # each sentence is (its index in the parse, its text, its entities)
+    from stanza.models.common.doc import Document
+    parsed = Document(doc_dicts).sentences
+
+    results = list()
+    for idx, sentence, sent_entities in sentences:
+
+        printing = num_line == mark_print
+        if printing:
+            print_sample_header(sentence)
+
+        # extract patterns / patterns from the sentence if that sentence contains more than 2 entities
+        if len(sent_entities) >= 2:
+            results.extend(pair_patterns(sent_entities, sentence, parsed[idx], printing))
+
+    return results
+
+
+class Stage:
+    """
+    One step of the extraction pipeline, run by one or more worker threads
+    Items of form (line number, payload) are taken from in_queue, transformed and put in out_queue
+    """
+
+    def __init__(self, name: str, func, in_queue: queue.Queue, out_queue: queue.Queue, workers: int = 1):
+
+        self.name = name
+        self.func = func
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.workers = workers
+
+        self.lock = threading.Lock()
+        self.running = workers
+        self.busy_time = 0.0
+        self.num_items = 0
+
+        # depth of the input queue, sampled whenever a worker takes an item
+        self.depth_sum = 0
+        self.depth_max = 0
+
+        self.threads = [threading.Thread(target=self.work, name='{}-{}'.format(name, idx), daemon=True)
+                        for idx in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+
+        while True:
+            item = self.in_queue.get()
+            depth = self.in_queue.qsize()
+
+            if item is STOP:
+                # let the other workers of this stage stop too, the last one tells the next stage
+                self.in_queue.put(STOP)
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last:
+                    self.out_queue.put(STOP)
+                return
+
+            num_line, payload = item
+            start = time.perf_counter()
+
+            # an error is passed on to the consumer instead of stopping the pipeline half way
+            if not isinstance(payload, Exception):
+                try:
+                    payload = self.func(num_line, payload)
+                except Exception as error:
+                    payload = error
+
+            with self.lock:
+                self.busy_time += time.perf_counter() - start
+                self.num_items += 1
+                self.depth_sum += depth
+                self.depth_max = max(self.depth_max, depth)
+
+            self.out_queue.put((num_line, payload))  # blocks while the next stage is behind
+
+    def report(self, wall_time: float) -> str:
+
+        utilisation = self.busy_time / (wall_time * self.workers) if wall_time > 0 else 0.0
+        mean_depth = self.depth_sum / self.num_items if self.num_items else 0.0
+
+        return '...{:<10} workers {:<3} items {:<8} utilisation {:6.1%}   queue depth mean {:6.1f} max {}'.format(
+            self.name, self.workers, self.num_items, utilisation, mean_depth, self.depth_max)
+
+
+def pipelined_extraction(data: List[str], args) -> Tuple[EntityTracker, PatternTracker, sparse.csr_matrix]:
+    """
+    Same result as extraction(), but parsing, NER tagging and feature extraction run at the same time
+    Stages are connected by bounded queues, so a fast stage waits for a slow one instead of filling memory
+    Patterns may be numbered in another order, as the worker processes iterate over sets in another order
+    Trackers are only updated by the calling thread, in the order of the lines, so results stay deterministic
+
+    :param data: list of lines of the corpus
+    :param args: arguments, with mark_print, queue_size and feature_workers (number of processes)
+    :return: entity tracker, pattern tracker and pair-pattern matrix
+    """
+
+    entity_tracker = EntityTracker()
+    pattern_tracker = PatternTracker()
+    spiller = get_spiller(args)
+
+    # the models only run on one copy of duplicate lines
+    canonical, num_copies = find_duplicates(data, args)
+    lines_to_run = [idx + 1 for idx, canon in enumerate(canonical) if idx == canon]
+    line_pairs = dict()  # { canonical line idx : [pairs] }, only for lines having duplicates
+
+    analyzer, ner_tagger = load_models(args)
+    mark_print = args.mark_print
+
+    def parse(num_line: int, line: str) -> List[Tuple[str, Sentence]]:
+
+        # perform analysis, including tokenized, parsing
+        sent_parsed = analyzer(line)
+        return [(' '.join([token.text for token in sent.tokens]), sent) for sent in sent_parsed.sentences]
+
+    def tag(num_line: int, sentences: List[Tuple[str, Sentence]]) -> List[Tuple[str, Sentence, List[tuple]]]:
+        return [(sentence, sent, ner_extract(sentence, ner_tagger)) for sentence, sent in sentences]
+
+    # feature extraction is pure Python, so it runs in processes to use more than one core
+    # spawn rather than fork, as the model threads are already running
+    pool = ProcessPoolExecutor(max_workers=args.feature_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def features(num_line: int, sentences: List[Tuple[str, Sentence, List[tuple]]]) -> list:
+
+        # only lines with a sentence of 2 entities or more are sent to a process
+        if not any(len(sent_entities) >= 2 for _, _, sent_entities in sentences):
+            return list()
+
+        doc_dicts = sentences[0][1].doc.to_dict()
+        return pool.submit(line_features, num_line, doc_dicts,
+                           [(idx, sentence, sent_entities) for idx, (sentence, _, sent_entities)
+                            in enumerate(sentences)], mark_print).result()
+
+    # one thread per model stage as the models are not thread-safe
+    # the threads of the features stage each wait on one process of the pool
+    queues = [queue.Queue(maxsize=args.queue_size) for _ in range(4)]
+    stages = [Stage('parse', parse, queues[0], queues[1]),
+              Stage('ner', tag, queues[1], queues[2]),
+              Stage('features', features, queues[2], queues[3], workers=args.feature_workers)]
+
+    start = time.perf_counter()
+    for stage in stages:
+        stage.start()
+
+    # lines are only read at most queue_size lines ahead of the tracker updates, so that the lines waiting
+    # for a slow one to be applied in order are bounded too
+    window = threading.Semaphore(args.queue_size)
+
+    def feed():
+        for num_line in lines_to_run:
+            window.acquire()
+            queues[0].put((num_line, data[num_line - 1]))
+        queues[0].put(STOP)
+
+    threading.Thread(target=feed, name='reader', daemon=True).start()
+
+    # single consumer, lines can arrive out of order from several feature workers, so apply them in order
+    pending = dict()
+    position = 0
+    consumer_time = 0.0
+    consumer_depth = 0
+
+    while True:
+        item = queues[3].get()
+        if item is STOP:
+            break
+        consumer_depth = max(consumer_depth, queues[3].qsize())
+
+        num_line, payload = item
+        pending[num_line] = payload
+
+        while position < len(lines_to_run) and lines_to_run[position] in pending:
+            next_line = lines_to_run[position]
+            results = pending.pop(next_line)
+            window.release()
+            if isinstance(results, Exception):
+                pool.shutdown(wait=False)
+                raise results
+
+            update_start = time.perf_counter()
+            update_trackers(results, entity_tracker, pattern_tracker)
+            if next_line - 1 in num_copies:
+                line_pairs[next_line - 1] = [result[0] for result in results]
+            if spiller is not None:
+                spiller.add(results, entity_tracker, pattern_tracker)
+            consumer_time += time.perf_counter() - update_start
+
+            if next_line == 300 or next_line == 500 or next_line == 700 or next_line == 900:
+                print('at line', next_line)
+            position += 1
+
+    pool.shutdown()
+    credit_duplicates(line_pairs, num_copies, entity_tracker)
+    wall_time = time.perf_counter() - start
+
+    print('=' * 50)
+    print('Pipeline stages, in {:.2f}s'.format(wall_time))
+    for stage in stages:
+        print(stage.report(wall_time))
+    print('...{:<10} workers {:<3} items {:<8} utilisation {:6.1%}   queue depth max {}'.format(
+        'trackers', 1, position, consumer_time / wall_time if wall_time > 0 else 0.0, consumer_depth))
+    print('=' * 50)
+
+    return finish_trackers(entity_tracker, pattern_tracker, spiller)
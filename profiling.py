@@ -0,0 +1,168 @@
+import os
+import time
+import heapq
+import pstats
+import cProfile
+from typing import List, Tuple, Set
+from collections import Counter
+from contextlib import contextmanager
+
+from entity_extraction import nested_entities, get_entity_text
+from feature_extraction import get_feature_tokens
+
+
+PROFILE_STAGES = ['stanza', 'flair', 'features', 'trackers']
+
+# functions of feature extraction whose time is reported from the features profile
+HOT_FUNCTIONS = ['extract_features', 'get_feature_tokens', 'get_power_set', 'check_feature_validity',
+                 'remove_tag_tail']
+
+
+class ExtractionProfiler:
+    """
+    Time each stage of extraction per sentence, and run cProfile only around the selected stages
+    The slowest sentences are kept in a heap of top_n items with their parse, to be reported at the end
+    """
+
+    def __init__(self, stages: List[str], top_n: int):
+
+        self.profiles = {stage: cProfile.Profile() for stage in stages}
+        self.top_n = top_n
+
+        self.totals = Counter()
+        self.line_times = Counter()  # stanza parses a whole line at once
+        self.sentence_times = Counter()
+
+        self.num_sentences = 0
+        self.slowest = list()  # heap of (seconds, sentence number, record)
+
+    @contextmanager
+    def measure(self, stage: str):
+
+        profile = self.profiles.get(stage)
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+
+            seconds = time.perf_counter() - start
+            self.totals[stage] += seconds
+            if stage == 'stanza':
+                self.line_times[stage] += seconds
+            else:
+                self.sentence_times[stage] += seconds
+
+    def start_line(self) -> None:
+        self.line_times = Counter()
+
+    def end_sentence(self, num_line: int, sentence: str, sent_entities: List[tuple], sent_parsed,
+                     results: List[Tuple[Tuple[str, str], str, str, List[Set[str]]]], num_sentences: int) -> None:
+
+        # the parse time of a line is shared by its sentences
+        times = dict(self.sentence_times)
+        times['stanza'] = self.line_times['stanza'] / num_sentences
+        seconds = sum(times.values())
+
+        self.num_sentences += 1
+        self.sentence_times = Counter()
+
+        if len(self.slowest) < self.top_n or seconds > self.slowest[0][0]:
+            record = {'line': num_line, 'sentence': sentence, 'entities': sent_entities, 'parsed': sent_parsed,
+                      'pairs': len(results), 'features': sum(len(result[3]) for result in results), 'times': times}
+            heapq.heappush(self.slowest, (seconds, self.num_sentences, record))
+            if len(self.slowest) > self.top_n:
+                heapq.heappop(self.slowest)
+
+    def report(self, path_to_dir: str) -> None:
+        """
+        Write a cProfile file and its top functions for each selected stage, and the report of slowest sentences
+
+        :param path_to_dir: folder of the profile files and report
+        """
+
+        os.makedirs(path_to_dir, exist_ok=True)
+        total = sum(self.totals.values())
+
+        print('=' * 50)
+        print('Time per stage over {} sentences'.format(self.num_sentences))
+        for stage in PROFILE_STAGES:
+            share = self.totals[stage] / total * 100 if total else 0.0
+            print('...{:<10} {:10.3f}s {:6.1f}%'.format(stage, self.totals[stage], share))
+
+        # a stage that never ran, e.g. features when no sentence has two entities, has no stats to write
+        for stage, profile in self.profiles.items():
+            if not profile.getstats():
+                print('No profile for {}, the stage did not run'.format(stage))
+                continue
+
+            profile.dump_stats(os.path.join(path_to_dir, 'profile_{}.prof'.format(stage)))
+            with open(os.path.join(path_to_dir, 'profile_{}.txt'.format(stage)), 'w', encoding='utf-8') as file:
+                pstats.Stats(profile, stream=file).sort_stats('cumulative').print_stats(30)
+
+        if 'features' in self.profiles and self.profiles['features'].getstats():
+            print('\nFeature extraction functions: calls, cumulative time')
+            for name, (calls, seconds) in hot_functions(self.profiles['features']).items():
+                print('...{:<24} {:10} {:10.3f}s'.format(name, calls, seconds))
+
+        slowest = sorted(self.slowest, reverse=True)
+        for _, _, record in slowest:
+            record['extra_tokens'] = max_extra_tokens(record)
+
+        with open(os.path.join(path_to_dir, 'slow_sentences.txt'), 'w', encoding='utf-8') as file:
+            for seconds, _, record in slowest:
+                file.write(sentence_report(seconds, record) + '\n')
+
+        print('\nSlowest {} sentences, seconds, entities, pairs, most extra tokens of a pair, features'.format(
+            len(slowest)))
+        for seconds, _, record in slowest[:5]:
+            print('...line {}: {:.3f}s, {}, {}, {}, {}'.format(record['line'], seconds, len(record['entities']),
+                                                                record['pairs'], record['extra_tokens'],
+                                                                record['features']))
+        print('Profiles and slow sentence report written to', path_to_dir)
+        print('=' * 50)
+
+
+def hot_functions(profile: cProfile.Profile) -> dict:
+
+    # { function name : (number of calls, cumulative seconds) }, summed over functions of the same name
+    functions = dict()
+    for (_, _, name), (_, num_calls, _, cumulative, _) in pstats.Stats(profile).stats.items():
+        if name in HOT_FUNCTIONS:
+            calls, seconds = functions.get(name, (0, 0.0))
+            functions[name] = (calls + num_calls, seconds + cumulative)
+
+    return {name: functions[name] for name in HOT_FUNCTIONS if name in functions}
+
+
+def max_extra_tokens(record: dict) -> int:
+
+    # the power set of the extra tokens of a pair grows as 2^n, so the pair with most of them explains a slow sentence
+    # they are computed again here for the few reported sentences, rather than for every sentence during extraction
+    entities = record['entities']
+    sentence = record['sentence']
+
+    most = 0
+    for i in range(len(entities) - 1):
+        for j in range(i + 1, len(entities)):
+            pair = (entities[i], entities[j])
+            if not nested_entities(pair) and \
+                    get_entity_text(pair[0], sentence).lower() != get_entity_text(pair[1], sentence).lower():
+                _, extra_tokens = get_feature_tokens(pair, record['parsed'])
+                most = max(most, len(extra_tokens))
+
+    return most
+
+
+def sentence_report(seconds: float, record: dict) -> str:
+
+    times = ', '.join('{} {:.1f} ms'.format(stage, record['times'].get(stage, 0.0) * 1000) for stage in PROFILE_STAGES)
+    return '\n'.join(['line {}: {:.1f} ms ({})'.format(record['line'], seconds * 1000, times),
+                      'entities {}, pairs {}, most extra tokens of a pair {}, features {}'.format(
+                          len(record['entities']), record['pairs'], record['extra_tokens'], record['features']),
+                      record['sentence'],
+                      '-' * 30])
@@ -0,0 +1,177 @@
+import os
+import time
+from typing import List, Tuple, Iterator, Optional
+from urllib.parse import quote
+from collections import Counter
+from scipy import sparse
+
+from entity_extraction import EntityTracker
+from feature_extraction import PatternTracker
+from clustering import get_ranked_patterns
+
+
+KG = 'http://example.org/covid-kg/'
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+RDFS_LABEL = 'http://www.w3.org/2000/01/rdf-schema#label'
+OWL_OBJECT_PROPERTY = 'http://www.w3.org/2002/07/owl#ObjectProperty'
+
+PREFIXES = {'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+            'owl': 'http://www.w3.org/2002/07/owl#'}
+
+# vocabulary terms written in short form in Turtle, entity and relation uris stay in full
+TURTLE_TERMS = {'<' + RDF_TYPE + '>': 'a',
+                '<' + RDFS_LABEL + '>': 'rdfs:label',
+                '<' + OWL_OBJECT_PROPERTY + '>': 'owl:ObjectProperty'}
+
+
+def uri(value: str) -> str:
+    return '<' + value + '>'
+
+
+def literal(value: str) -> str:
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return '"' + escaped + '"'
+
+
+def kg_uri(kind: str, name: str) -> str:
+    return uri(KG + kind + '/' + quote(name, safe=''))
+
+
+class ChunkedWriter:
+    """
+    Write triples to numbered files of at most chunk_size triples each, so that a triple store can load them in
+    parallel. Lines are buffered and written per buffer, nothing else is kept in memory
+    """
+
+    def __init__(self, path_to_dir: str, rdf_format: str, chunk_size: int, buffer_size: int = 10000):
+
+        # checked before the chunks of an earlier export are removed
+        if chunk_size < 1:
+            raise ValueError('chunk_triples must be at least 1, got {}'.format(chunk_size))
+
+        self.path_to_dir = path_to_dir
+        self.rdf_format = rdf_format
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+
+        self.paths = list()
+        self.buffer = list()
+        self.num_triples = 0
+        self.file = None
+
+        # chunks of an earlier export are removed, a smaller export would otherwise leave some of them behind
+        os.makedirs(path_to_dir, exist_ok=True)
+        for filename in os.listdir(path_to_dir):
+            if filename.startswith('kg_') and filename.endswith(('.nt', '.ttl')):
+                os.remove(os.path.join(path_to_dir, filename))
+
+    def open_chunk(self) -> None:
+
+        path_to_file = os.path.join(self.path_to_dir, 'kg_{:04d}.{}'.format(len(self.paths), self.rdf_format))
+        self.file = open(path_to_file, 'w', encoding='utf-8')
+        self.paths.append(path_to_file)
+
+        if self.rdf_format == 'ttl':
+            for prefix, namespace in PREFIXES.items():
+                self.file.write('@prefix {}: {} .\n'.format(prefix, uri(namespace)))
+            self.file.write('\n')
+
+    def write(self, terms: Tuple[str, str, str]) -> None:
+
+        if self.num_triples % self.chunk_size == 0:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+            self.open_chunk()
+
+        if self.rdf_format == 'ttl':
+            terms = [TURTLE_TERMS.get(term, term) for term in terms]
+
+        self.buffer.append('{} {} {} .\n'.format(*terms))
+        self.num_triples += 1
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.file.write(''.join(self.buffer))
+            self.buffer = list()
+
+    def close(self) -> List[str]:
+
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+        return self.paths
+
+
+def relation_label(vector: sparse.spmatrix, pattern_tracker: PatternTracker, num_patterns: int) -> str:
+
+    # a relation is named by the top patterns of its cluster, e.g. "inhibit | bind receptor"
+    patterns, _, _ = get_ranked_patterns(vector, pattern_tracker)
+    return ' | '.join(' '.join(sorted(pattern)) for pattern in patterns[:num_patterns])
+
+
+def generate_triples(entity_tracker: EntityTracker, pattern_tracker: PatternTracker, clusters: Optional[dict],
+                     cp_matrix: Optional[sparse.spmatrix], entity2uri: dict,
+                     num_patterns: int) -> Iterator[Tuple[str, str, str]]:
+    """
+    Triples of our knowledge graph, one at a time
+
+    :param entity_tracker: entity tracker from extraction
+    :param pattern_tracker: pattern tracker from extraction
+    :param clusters: dict with cluster labels of the pairs in the pair-pattern matrix, or None
+    :param cp_matrix: cluster-pattern matrix, or None
+    :param entity2uri: uris of cido nodes matching our entities, which are used instead of new ones
+    :param num_patterns: number of top patterns in the label of a relation
+    :return: iterator of (subject, predicate, object) terms in N-Triples form
+    """
+
+    def entity_uri(entity: str) -> str:
+        return uri(entity2uri[entity]) if entity in entity2uri else kg_uri('entity', entity)
+
+    # entities with their most frequent type, as in the store
+    for entity, ne_types in entity_tracker.entity2type.items():
+        subj = entity_uri(entity)
+        yield subj, uri(RDF_TYPE), kg_uri('type', Counter(ne_types).most_common(1)[0][0])
+        yield subj, uri(RDFS_LABEL), literal(entity)
+
+    # one relation per cluster, labelled with its top patterns
+    if clusters is not None:
+        cp_matrix = sparse.csr_matrix(cp_matrix)
+        for cid in range(clusters['n_clusters']):
+            relation = kg_uri('relation', 'cluster_{}'.format(cid))
+            yield relation, uri(RDF_TYPE), uri(OWL_OBJECT_PROPERTY)
+            yield relation, uri(RDFS_LABEL), literal(relation_label(cp_matrix[cid], pattern_tracker, num_patterns))
+
+    # every pair co-occurs, pairs with patterns are also linked by the relation of their cluster
+    co_occurs = kg_uri('relation', 'co_occurs_with')
+    for pair in entity_tracker.entity_pairs:
+        head, tail = entity_uri(pair[0]), entity_uri(pair[1])
+        yield head, co_occurs, tail
+
+        if clusters is not None and pair in entity_tracker.pair2idx:
+            cid = int(clusters['labels'][entity_tracker.pair2idx[pair]])
+            yield head, kg_uri('relation', 'cluster_{}'.format(cid)), tail
+
+
+def export_rdf(entity_tracker: EntityTracker, pattern_tracker: PatternTracker, clusters: Optional[dict],
+               cp_matrix: Optional[sparse.spmatrix], entity2uri: dict, args) -> List[str]:
+
+    start = time.perf_counter()
+
+    writer = ChunkedWriter(os.path.join(args.path_to_data_dir, 'rdf'), args.rdf_format, args.chunk_triples)
+    for terms in generate_triples(entity_tracker, pattern_tracker, clusters, cp_matrix, entity2uri,
+                                  args.num_patterns):
+        writer.write(terms)
+    paths = writer.close()
+
+    print('=' * 50)
+    print('Wrote {} triples to {} files in {:.2f}s'.format(writer.num_triples, len(paths), time.perf_counter() - start))
+    print('Entities with a CIDO uri:', len(entity2uri.keys() & entity_tracker.entity2type.keys()))
+    print('First file:', paths[0] if paths else None)
+    print('=' * 50)
+
+    return paths
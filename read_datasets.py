@@ -1,13 +1,22 @@
+from __future__ import annotations
 import _pickle as cPickle
 import bz2
 import os
-import rdflib
-from rdflib import ConjunctiveGraph
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    from rdflib import ConjunctiveGraph
 
-def load_cido() -> ConjunctiveGraph:
 
-    path_to_cido = 'https://raw.githubusercontent.com/CIDO-ontology/cido/master/src/ontology/cido.owl'
+CIDO_URL = 'https://raw.githubusercontent.com/CIDO-ontology/cido/master/src/ontology/cido.owl'
+
+
+def load_cido(path_to_cido: str = CIDO_URL) -> ConjunctiveGraph:
+
+    # rdflib is only needed by evaluation, do not import it for other stages
+    import rdflib
+    from rdflib import ConjunctiveGraph
+
     graph = ConjunctiveGraph()
     graph.parse(path_to_cido, format=rdflib.util.guess_format(path_to_cido))
 
@@ -0,0 +1,270 @@
+from __future__ import annotations
+import json
+import time
+import queue
+import threading
+from bisect import bisect_right
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import flair
+
+from extraction import *
+from timing import startup_timer
+
+
+class ExtractionRequest:
+
+    def __init__(self, text: str):
+
+        self.text = text
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ServiceStats:
+
+    def __init__(self, max_latencies: int = 10000):
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.latencies = deque(maxlen=max_latencies)  # in ms, of the latest requests
+        self.batch_sizes = Counter()  # histogram { batch size : number of batches }
+
+    def add_latency(self, latency: float, failed: bool = False):
+
+        # failed requests count in the latencies too, they also kept a client waiting
+        with self.lock:
+            self.num_requests += 1
+            self.num_errors += int(failed)
+            self.latencies.append(latency)
+
+    def add_batch(self, size: int):
+        with self.lock:
+            self.batch_sizes.update([size])
+
+    def report(self) -> dict:
+
+        with self.lock:
+            latencies = sorted(self.latencies)
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+            num_requests = self.num_requests
+            num_errors = self.num_errors
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {'requests': num_requests,
+                'errors': num_errors,
+                'latency_ms': {'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+                               'p50': percentile(0.5),
+                               'p95': percentile(0.95),
+                               'max': latencies[-1] if latencies else 0.0},
+                'batch_sizes': batch_sizes}
+
+
+class MicroBatcher:
+    """
+    Collect texts from concurrent requests and run the models on them together
+    A batch is closed when it reaches max_batch texts or batch_window seconds after its first text arrived
+    """
+
+    def __init__(self, analyzer, ner_tagger, max_batch: int, batch_window: float, stats: ServiceStats):
+
+        self.analyzer = analyzer
+        self.ner_tagger = ner_tagger
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.stats = stats
+        self.requests = queue.Queue()
+
+        # only this thread touches the models
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, texts: List[str]) -> List[list]:
+
+        requests = [ExtractionRequest(text) for text in texts]
+        for request in requests:
+            self.requests.put(request)
+
+        results = list()
+        for request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise request.error
+            results.append(request.result)
+
+        return results
+
+    def next_batch(self) -> List[ExtractionRequest]:
+
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.batch_window
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self):
+
+        while True:
+            batch = self.next_batch()
+            self.stats.add_batch(len(batch))
+
+            try:
+                results = extract_batch([request.text for request in batch], self.analyzer, self.ner_tagger)
+            except Exception as error:
+                # parsing or tagging the batch failed, run each text on its own so only the text causing it fails
+                results = [error] if len(batch) == 1 else [self.extract_one(request.text) for request in batch]
+
+            for request, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    request.error = result
+                else:
+                    request.result = result
+                request.done.set()
+
+    def extract_one(self, text: str):
+        try:
+            return extract_batch([text], self.analyzer, self.ner_tagger)[0]
+        except Exception as error:
+            return error
+
+
+def extract_batch(texts: List[str], analyzer, ner_tagger) -> List[List[dict]]:
+    """
+    Parse, tag and extract patterns of several texts at once, with the same logic as extraction()
+
+    :param texts: list of texts, each can have more than one sentence
+    :param analyzer: stanza pipeline
+    :param ner_tagger: flair tagger
+    :return: for each text, a list of results, one per sentence, or the error raised by one of its sentences
+    """
+
+    # one stanza document for the whole batch, blank lines keep sentences of different texts apart
+    starts = list()
+    offset = 0
+    for text in texts:
+        starts.append(offset)
+        offset += len(text) + 2
+    doc = analyzer('\n\n'.join(texts))
+
+    sentences = [' '.join([token.text for token in sent.tokens]) for sent in doc.sentences]
+    flair_sentences = [flair.data.Sentence(sentence) for sentence in sentences]
+    if flair_sentences:
+        ner_tagger.predict(flair_sentences)  # predict NER tags of all sentences at once
+
+    results = [list() for _ in texts]
+    for sent_parsed, sentence, flair_sentence in zip(doc.sentences, sentences, flair_sentences):
+        text_idx = bisect_right(starts, sent_parsed.tokens[0].start_char) - 1
+        if isinstance(results[text_idx], Exception):
+            continue
+
+        # an error in one sentence only fails the text it belongs to
+        try:
+            results[text_idx].append(sentence_result(sentence, sent_parsed, extract_entity(flair_sentence)))
+        except Exception as error:
+            results[text_idx] = error
+
+    return results
+
+
+def sentence_result(sentence: str, sent_parsed: Sentence, sent_entities: List[tuple]) -> dict:
+
+    # trackers of only this sentence, filled by the same pattern_extract as the batch extraction
+    entity_tracker = EntityTracker()
+    pattern_tracker = PatternTracker()
+
+    if len(sent_entities) >= 2:
+        pattern_extract(sent_entities, sentence, sent_parsed, entity_tracker, pattern_tracker, False)
+
+    entities = [{'text': get_entity_text(entity, sentence), 'start': entity[0], 'end': entity[1], 'type': entity[2]}
+                for entity in sent_entities]
+    pairs = [{'pair': list(pair), 'patterns': [sorted(pattern) for pattern in patterns]}
+             for pair, patterns in pattern_tracker.pairs2patterns.items()]
+
+    return {'sentence': sentence, 'entities': entities, 'pairs': pairs}
+
+
+def make_handler(batcher: MicroBatcher, stats: ServiceStats):
+
+    class ExtractionHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code: int, data: dict):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, stats.report())
+            else:
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+        def do_POST(self):
+            if self.path != '/extract':
+                self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                return
+
+            # body of form {"sentences": ["...", "..."]} or {"text": "..."}
+            start = time.perf_counter()
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                texts = data['sentences'] if 'sentences' in data else [data['text']]
+                if not isinstance(texts, list):
+                    raise ValueError('sentences must be a list')
+                if not all(isinstance(text, str) for text in texts):
+                    raise ValueError('sentences must be strings')
+            except (ValueError, KeyError, TypeError) as error:
+                stats.add_latency((time.perf_counter() - start) * 1000, failed=True)
+                self.send_json(400, {'error': 'bad request: {}'.format(error)})
+                return
+
+            try:
+                results = batcher.submit(texts)
+            except Exception as error:
+                stats.add_latency((time.perf_counter() - start) * 1000, failed=True)
+                self.send_json(500, {'error': str(error)})
+                return
+
+            latency = (time.perf_counter() - start) * 1000
+            stats.add_latency(latency)
+            self.send_json(200, {'results': results, 'latency_ms': latency})
+
+    return ExtractionHandler
+
+
+def serve(args) -> None:
+
+    # load models only once for the lifetime of the service
+    analyzer, ner_tagger = load_models(args)
+    startup_timer.report()
+
+    stats = ServiceStats()
+    batcher = MicroBatcher(analyzer, ner_tagger, args.max_batch, args.batch_window / 1000, stats)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, stats))
+
+    print('=' * 50)
+    print('Extraction service listening on http://{}:{}'.format(args.host, args.port))
+    print('POST /extract with {"sentences": [...]}, GET /stats for latency and batch sizes')
+    print('=' * 50)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Service stats', json.dumps(stats.report()))
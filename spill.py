@@ -0,0 +1,211 @@
+import os
+import shutil
+import pickle
+import heapq
+import tempfile
+import numpy as np
+from typing import List, Set, Tuple, Iterator, Iterable, Callable
+from itertools import groupby
+from operator import itemgetter
+from collections import Counter
+from scipy import sparse
+
+from entity_extraction import EntityTracker
+from feature_extraction import PatternTracker
+
+
+# rough size in memory of one stored reference in the trackers, e.g. one pattern of a pair or one type of an entity,
+# including the share of dict, list and tuple overhead around it
+BYTES_PER_ENTRY = 100
+
+# most run files open at once while merging, more runs are first merged in groups into intermediate runs
+MAX_OPEN_RUNS = 64
+
+
+class TrackerSpiller:
+    """
+    Keep the trackers under a memory budget during extraction
+    When the trackers grow past the budget, their state is written to sorted runs on disk and the trackers are emptied:
+    pair --> (occurrences, covid pair or not, pattern id counts) and entity --> type counts
+    At the end, the runs are merged in one streaming pass into the final trackers and the pair-pattern matrix
+    """
+
+    def __init__(self, memory_budget: int, path_to_data_dir: str):
+
+        self.max_entries = memory_budget * 1024 * 1024 // BYTES_PER_ENTRY
+        self.num_entries = 0
+
+        self.run_dir = tempfile.mkdtemp(prefix='spill_', dir=path_to_data_dir)
+        self.pair_runs = list()
+        self.entity_runs = list()
+
+        # patterns stay in memory so that every run uses the same pattern ids
+        self.pattern2idx = dict()
+
+    def add(self, results: List[Tuple[Tuple[str, str], str, str, List[Set[str]]]],
+            entity_tracker: EntityTracker, pattern_tracker: PatternTracker) -> None:
+
+        # results have already been added to the trackers, only count what they hold now
+        for _, _, _, patterns in results:
+            self.num_entries += len(patterns) + 6
+
+        if self.num_entries > self.max_entries:
+            self.flush(entity_tracker, pattern_tracker)
+
+    def index_patterns(self, pattern_tracker: PatternTracker) -> None:
+        for idx in range(len(self.pattern2idx), len(pattern_tracker.patterns)):
+            self.pattern2idx[frozenset(pattern_tracker.patterns[idx])] = idx
+
+    def flush(self, entity_tracker: EntityTracker, pattern_tracker: PatternTracker) -> None:
+
+        self.index_patterns(pattern_tracker)
+        run_idx = len(self.pair_runs)
+
+        # records sorted by pair / entity, so that runs can be merged without loading them
+        pairs = sorted(set(pattern_tracker.pairs2patterns) | set(entity_tracker.occurrence_counter))
+        pair_records = list()
+        for pair in pairs:
+            patterns = pattern_tracker.pairs2patterns.get(pair, [])
+            counts = Counter(self.pattern2idx[frozenset(pattern)] for pattern in patterns)
+            pair_records.append((pair, entity_tracker.occurrence_counter[pair], pair in entity_tracker.covid_pairs,
+                                 pair in pattern_tracker.pairs2patterns, sorted(counts.items())))
+
+        entity_records = [(entity, sorted(Counter(types).items()))
+                          for entity, types in sorted(entity_tracker.entity2type.items())]
+
+        self.pair_runs.append(write_run(pair_records, os.path.join(self.run_dir, 'pairs_{}.run'.format(run_idx))))
+        self.entity_runs.append(write_run(entity_records,
+                                          os.path.join(self.run_dir, 'entities_{}.run'.format(run_idx))))
+
+        # empty the trackers, patterns are kept as they are the vocabulary
+        entity_tracker.clear()
+        pattern_tracker.clear(keep_patterns=True)
+        self.num_entries = 0
+
+    def merge(self, entity_tracker: EntityTracker,
+              pattern_tracker: PatternTracker) -> Tuple[EntityTracker, PatternTracker, sparse.csr_matrix]:
+        """
+        Flush what is left in the trackers and merge all runs into the final trackers and pair-pattern matrix
+
+        :param entity_tracker: entity tracker of the extraction, with the state since the last flush
+        :param pattern_tracker: pattern tracker of the extraction, with the state since the last flush
+        :return: entity tracker, pattern tracker and pair-pattern matrix, as from an extraction without budget
+        """
+
+        self.flush(entity_tracker, pattern_tracker)
+        print('Merging {} runs of trackers spilled to disk'.format(len(self.pair_runs)))
+
+        merged_entities = EntityTracker()
+        merged_patterns = PatternTracker()
+        merged_patterns.patterns = pattern_tracker.patterns
+
+        rows = list()
+        cols = list()
+        counts = list()
+
+        pair_runs = self.reduce_runs(self.pair_runs, combine_pair_records, 'pairs')
+        for pair, occurrences, covid, has_patterns, pattern_counts in merge_runs(pair_runs, combine_pair_records):
+
+            merged_entities.entity_pairs.add(pair)
+            merged_entities.occurrence_counter[pair] = occurrences
+            if covid:
+                merged_entities.covid_pairs.add(pair)
+
+            if has_patterns:
+                # same pattern objects as in the vocabulary, one per occurrence as in PatternTracker.update
+                merged_patterns.pairs2patterns[pair] = [merged_patterns.patterns[idx]
+                                                        for idx, count in pattern_counts
+                                                        for _ in range(count)]
+
+            if pattern_counts:
+                merged_entities.add_pair_idx(pair)
+                rows.extend([merged_entities.pair2idx[pair]] * len(pattern_counts))
+                cols.extend(idx for idx, _ in pattern_counts)
+                counts.extend(count for _, count in pattern_counts)
+
+        entity_runs = self.reduce_runs(self.entity_runs, combine_entity_records, 'entities')
+        for entity, type_counts in merge_runs(entity_runs, combine_entity_records):
+            for ne_type, count in type_counts:
+                merged_entities.entity2type.setdefault(entity, []).extend([ne_type] * count)
+                merged_entities.type2entity.setdefault(ne_type, []).extend([entity] * count)
+
+        matrix = sparse.csr_matrix((np.asarray(counts, dtype=np.int64), (rows, cols)),
+                                   shape=(len(merged_entities.pair2idx), len(merged_patterns.patterns)))
+
+        print('=' * 50)
+        print('Highest count of features:', max(counts) if counts else 0)
+        print('=' * 50)
+
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        return merged_entities, merged_patterns, matrix
+
+    def reduce_runs(self, paths: List[str], combine: Callable, prefix: str) -> List[str]:
+
+        # merge groups of runs into intermediate runs, pass after pass, until they can all be opened at once
+        level = 0
+        while len(paths) > MAX_OPEN_RUNS:
+            merged = list()
+            for start in range(0, len(paths), MAX_OPEN_RUNS):
+                group = paths[start:start + MAX_OPEN_RUNS]
+                path_to_file = os.path.join(self.run_dir, '{}_merged_{}_{}.run'.format(prefix, level, len(merged)))
+                merged.append(write_run(merge_runs(group, combine), path_to_file))
+
+                for path in group:
+                    os.remove(path)
+
+            paths = merged
+            level += 1
+
+        return paths
+
+
+def merge_runs(paths: List[str], combine: Callable) -> Iterator[tuple]:
+
+    # one record per key, combined from the records of that key in all runs
+    records = heapq.merge(*[read_run(path) for path in paths], key=itemgetter(0))
+    for key, key_records in groupby(records, key=itemgetter(0)):
+        yield combine(key, key_records)
+
+
+def combine_pair_records(pair: Tuple[str, str], records: Iterable[tuple]) -> tuple:
+
+    occurrences = 0
+    covid = False
+    has_patterns = False
+    pattern_counts = Counter()
+
+    for _, run_occurrences, run_covid, run_has_patterns, run_counts in records:
+        occurrences += run_occurrences
+        covid = covid or run_covid
+        has_patterns = has_patterns or run_has_patterns
+        pattern_counts.update(dict(run_counts))
+
+    return pair, occurrences, covid, has_patterns, sorted(pattern_counts.items())
+
+
+def combine_entity_records(entity: str, records: Iterable[tuple]) -> tuple:
+
+    type_counts = Counter()
+    for _, run_counts in records:
+        type_counts.update(dict(run_counts))
+
+    return entity, sorted(type_counts.items())
+
+
+def write_run(records: Iterable[tuple], path_to_file: str) -> str:
+
+    with open(path_to_file, 'wb') as file:
+        for record in records:
+            pickle.dump(record, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return path_to_file
+
+
+def read_run(path_to_file: str) -> Iterator[tuple]:
+
+    with open(path_to_file, 'rb') as file:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
@@ -0,0 +1,34 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupTimer:
+
+    def __init__(self):
+
+        # list of (stage, step, seconds) in the order they were measured
+        self.records = list()
+
+    @contextmanager
+    def measure(self, stage: str, step: str):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.records.append((stage, step, time.perf_counter() - start))
+
+    def report(self) -> None:
+
+        if not self.records:
+            return
+
+        print('=' * 50)
+        print('Startup time per stage')
+        for stage, step, seconds in self.records:
+            print('...{:<12} {:<24} {:8.3f}s'.format(stage, step, seconds))
+        print('=' * 50)
+
+
+# one timer for the whole run, shared by main and the stages
+startup_timer = StartupTimer()